@@ -0,0 +1,428 @@
+#!/usr/bin/python
+# File:        bench.py
+# Description: benchmarks for the overlay pipeline
+# Created:     2026-10-17
+
+"""Benchmarks for parsing, rendering and sending overlay frames.
+
+Results can be written as JSON and compared between runs. Only the
+unpremultiply benchmark needs external programs."""
+
+import argparse
+import sys
+import os
+import io
+import time
+import random
+from common import ArgvError
+
+
+RESULTS_VERSION = 1
+
+
+class Results(object):
+
+    """Collect named measurements; all values are rates, higher is better."""
+
+    def __init__(self, params):
+        self.params = params
+        self.records = []
+
+    def add(self, name, value, unit):
+        self.records.append({'name': name, 'value': value, 'unit': unit})
+        print("%-36s %14.1f %s" % (name, value, unit))
+        sys.stdout.flush()
+
+    def dump(self, path):
+        import json
+        import platform
+        data = {
+            'version': RESULTS_VERSION,
+            'created': time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'params': self.params,
+            'results': self.records,
+        }
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=2)
+            f.write("\n")
+
+
+def generate_events(out, duration, button_rate, axis_rate, noise, seed=1):
+    """Write a synthetic jstest --event recording of an xpad controller.
+
+    Buttons and dpad directions are pressed button_rate times per second,
+    axes move axis_rate times per second. Every axis value gets gaussian
+    noise of the given amplitude added."""
+    rng = random.Random(seed)
+    out.write("Driver version is 2.1.0.\n"
+              "Joystick (Microsoft X-Box One pad) has 8 axes "
+              "(X, Y, Z, Rx, Ry, Rz, Hat0X, Hat0Y)\n"
+              "and 11 buttons (BtnA, BtnB, BtnX, BtnY, BtnTL, BtnTR, "
+              "BtnSelect, BtnStart, BtnMode, BtnThumbL, BtnThumbR).\n"
+              "Testing ... (interrupt to exit)\n")
+    start = 1000000
+    end = start + int(duration * 1000)
+    axes = [0, 0, -32767, 0, 0, -32767, 0, 0]
+    for n in range(11):
+        out.write("Event: type 129, time %d, number %d, value 0\n" % (start, n))
+    for n, value in enumerate(axes):
+        out.write("Event: type 130, time %d, number %d, value %d\n" % (start, n, value))
+
+    events = []
+    t = float(start)
+    while button_rate > 0:
+        t += rng.expovariate(button_rate) * 1000
+        if t >= end:
+            break
+        release = t + rng.expovariate(1 / 150)
+        n = rng.randrange(13)
+        if n < 11:
+            events.append((int(t), 1, n, 1))
+            events.append((int(release), 1, n, 0))
+        else:
+            # dpad directions are axes 6 and 7
+            events.append((int(t), 2, n - 5, rng.choice((-32767, 32767))))
+            events.append((int(release), 2, n - 5, 0))
+    t = float(start)
+    while axis_rate > 0:
+        t += rng.expovariate(axis_rate) * 1000
+        if t >= end:
+            break
+        n = rng.choice((0, 1, 2, 3, 4, 5))
+        value = axes[n] + rng.gauss(0, 4000) + rng.gauss(0, noise)
+        axes[n] = value = max(-32767, min(32767, int(value)))
+        events.append((int(t), 2, n, value))
+    events.sort(key=lambda e: e[0])
+    write = out.write
+    for t, type, number, value in events:
+        write("Event: type %d, time %d, number %d, value %d\n" % (type, t, number, value))
+
+
+def load_events(args):
+    """Return the text of the recording to benchmark with."""
+    if args.events is not None:
+        with open(args.events, 'r') as f:
+            return f.read()
+    out = io.StringIO()
+    generate_events(out, args.duration, args.button_rate, args.axis_rate,
+                    args.noise, args.seed)
+    return out.getvalue()
+
+
+def load_overlay_script():
+    """Import ffmpeg-overlay.py, which cannot be imported by name."""
+    import runpy
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ffmpeg-overlay.py')
+    return argparse.Namespace(**runpy.run_path(path))
+
+
+def load_layout(args):
+    import overlayapi as api
+    api.import_all_config()
+    try:
+        ctype = api.CONTROLLER_TYPES[args.type]()
+    except KeyError:
+        raise ArgvError("no such controller type: %r" % (args.type,), args.parser)
+    try:
+        layout = api.LAYOUTS[args.layout](ctype)
+    except KeyError:
+        raise ArgvError("no such layout: %r" % (args.layout,), args.parser)
+    try:
+        theme = api.THEMES[args.theme]()
+    except KeyError:
+        raise ArgvError("no such theme: %s" % (args.theme,), args.parser)
+    return ctype, layout, theme
+
+
+def bench_parse(args, results):
+    import js
+    text = load_events(args)
+    nlines = text.count("\n")
+
+    def parse(stream):
+        evs = js.HandlerJsEvents(stream)
+        js.AllstatesHandler(evs).attach()
+        start = time.perf_counter()
+        evs.work_all()
+        return time.perf_counter() - start
+
+    elapsed = min(parse(io.StringIO(text)) for _ in range(args.repeat))
+    results.add("parse.text", nlines / elapsed, "lines/s")
+
+    packed = io.BytesIO()
+    js.write_event_file(io.StringIO(text), packed)
+    data = packed.getvalue()
+    elapsed = min(parse(js.EventFile(data)) for _ in range(args.repeat))
+    results.add("parse.binary", nlines / elapsed, "lines/s")
+
+
+def bench_render(args, results):
+    ffo = load_overlay_script()
+    ctype, layout, theme = load_layout(args)
+    text = load_events(args)
+    animargs = argparse.Namespace(start=0, delay=0, absstart=0, fps=args.fps,
+                                  sprite_cache=None, dedup=False,
+                                  cache_background=False, timeline=False,
+                                  label_masks=False, seek_index=False)
+    nframes = int(args.duration * args.fps)
+    best = None
+    for _ in range(args.repeat):
+        surface, cctx = ffo.create_surface(layout, args.scale)
+        anim = ffo.create_animation(animargs, layout, ctype, theme, io.StringIO(text))
+        anim.init()
+        writer = ffo.FFMpegWriter(surface, cctx, [], fps=args.fps,
+                                  backend=args.backend)
+        with ffo.FdStream(os.open(os.devnull, os.O_WRONLY)) as writer._stream:
+            times = [0.0, 0.0, 0.0]
+            clock = time.perf_counter
+            for i in range(nframes):
+                t0 = clock()
+                anim.update(i)
+                t1 = clock()
+                anim.draw(cctx)
+                t2 = clock()
+                writer.save_frame()
+                t3 = clock()
+                times[0] += t1 - t0
+                times[1] += t2 - t1
+                times[2] += t3 - t2
+        if best is None:
+            best = times
+        else:
+            best = [min(a, b) for a, b in zip(best, times)]
+    results.add("render.update", nframes / best[0], "frames/s")
+    results.add("render.draw", nframes / best[1], "frames/s")
+    results.add("render.save_frame", nframes / best[2], "frames/s")
+    results.add("render.total", nframes / sum(best), "frames/s")
+
+
+def frame_sizes(args):
+    ctype, layout, theme = load_layout(args)
+    for scale in args.scales:
+        scale = layout.scale * scale
+        yield int(layout.width * scale), int(layout.height * scale)
+
+
+def make_frames(width, height, count, partial, seed=1):
+    """Generate premultiplied bgra frames.
+
+    A partial fraction of the pixels is semi-transparent, the rest is
+    split between transparent and opaque."""
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    frames = []
+    npixels = width * height
+    for _ in range(count):
+        alpha = np.where(rng.random(npixels) < partial,
+                         rng.integers(1, 255, npixels),
+                         rng.choice((0, 255), npixels)).astype(np.uint8)
+        pixels = np.empty((npixels, 4), dtype=np.uint8)
+        pixels[:, :3] = rng.integers(0, 256, (npixels, 3))
+        pixels[:, :3] = np.minimum(pixels[:, :3], alpha[:, None])
+        pixels[:, 3] = alpha
+        frames.append(pixels.tobytes())
+    return frames
+
+
+def run_external(args, frames, width, height):
+    import subprocess
+    proc = subprocess.Popen((args.unpremultiply,), stdin=subprocess.PIPE,
+                            stdout=subprocess.DEVNULL)
+    for i in range(args.frames):
+        proc.stdin.write(frames[i % len(frames)])
+    proc.stdin.close()
+    proc.wait()
+
+
+def run_numpy(args, frames, width, height):
+    from unpremultiply import unpremultiply
+    buf = bytearray(len(frames[0]))
+    for i in range(args.frames):
+        buf[:] = frames[i % len(frames)]
+        unpremultiply(buf)
+
+
+def _run_ffmpeg(args, frames, width, height, filter):
+    import subprocess
+    command = (args.ffmpeg, '-loglevel', 'error', '-f', 'rawvideo',
+               '-pix_fmt', 'bgra', '-s', '%dx%d' % (width, height),
+               '-r', '60', '-i', 'pipe:0', '-vf', filter, '-f', 'null', '-')
+    proc = subprocess.Popen(command, stdin=subprocess.PIPE)
+    for i in range(args.frames):
+        proc.stdin.write(frames[i % len(frames)])
+    proc.stdin.close()
+    if proc.wait() != 0:
+        raise RuntimeError("ffmpeg exited with status %d" % proc.returncode)
+
+
+def run_ffmpeg(args, frames, width, height):
+    _run_ffmpeg(args, frames, width, height, 'unpremultiply=inplace=1')
+
+
+def run_ffmpeg_null(args, frames, width, height):
+    _run_ffmpeg(args, frames, width, height, 'null')
+
+
+UNPREMULTIPLY_BACKENDS = {
+    'external': run_external,
+    'numpy': run_numpy,
+    'ffmpeg': run_ffmpeg,
+    # baseline for the ffmpeg backend: decoding and piping without filter
+    'ffmpeg-null': run_ffmpeg_null,
+}
+
+
+def bench_unpremultiply(args, results):
+    for name in args.backends:
+        if name not in UNPREMULTIPLY_BACKENDS:
+            raise ArgvError("no such backend: %r" % (name,), args.parser)
+    for width, height in frame_sizes(args):
+        frames = make_frames(width, height, 8, args.partial)
+        for name in args.backends:
+            func = UNPREMULTIPLY_BACKENDS[name]
+            best = None
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                func(args, frames, width, height)
+                elapsed = time.perf_counter() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+            results.add("unpremultiply.%s.%dx%d" % (name, width, height),
+                        args.frames / best, "frames/s")
+
+
+def bench_all(args, results):
+    bench_parse(args, results)
+    bench_render(args, results)
+
+
+def generate(args):
+    if args.output == '-':
+        generate_events(sys.stdout, args.duration, args.button_rate,
+                        args.axis_rate, args.noise, args.seed)
+    else:
+        with open(args.output, 'w') as out:
+            generate_events(out, args.duration, args.button_rate,
+                            args.axis_rate, args.noise, args.seed)
+    return 0
+
+
+def compare(args):
+    import json
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    for data, path in ((old, args.old), (new, args.new)):
+        if data.get('version') != RESULTS_VERSION:
+            raise ArgvError("unsupported results file: %s" % (path,), args.parser)
+    oldvalues = {r['name']: r for r in old['results']}
+    regressions = 0
+    for record in new['results']:
+        name = record['name']
+        try:
+            before = oldvalues[name]['value']
+        except KeyError:
+            continue
+        change = record['value'] / before - 1
+        if change < -args.threshold:
+            mark = "  slower"
+            regressions += 1
+        elif change > args.threshold:
+            mark = "  faster"
+        else:
+            mark = ""
+        print("%-36s %14.1f %14.1f %+7.1f%%%s" % (name, before, record['value'],
+                                                 change * 100, mark))
+    return 1 if regressions else 0
+
+
+def main(argv):
+    progname = argv.pop(0).rpartition('/')[2]
+
+    parser = argparse.ArgumentParser(prog=progname, description="""
+    Benchmarks for parts of the overlay pipeline.""")
+    subparsers = parser.add_subparsers(dest='bench', metavar='BENCH')
+    subparsers.required = True
+
+    events = argparse.ArgumentParser(add_help=False)
+    events.add_argument('--duration', type=float, default=60, help="Seconds of synthetic events (default: 60)")
+    events.add_argument('--button-rate', type=float, default=4, help="Button presses per second (default: 4)")
+    events.add_argument('--axis-rate', type=float, default=100, help="Axis events per second (default: 100)")
+    events.add_argument('--noise', type=float, default=200, help="Amplitude of axis noise (default: 200)")
+    events.add_argument('--seed', type=int, default=1, help="Random seed")
+
+    layout = argparse.ArgumentParser(add_help=False)
+    layout.add_argument('-t', '--type', default='xpad', help="Controller type to use")
+    layout.add_argument('-l', '--layout', default='distance', help="Layout to use")
+    layout.add_argument('-T', '--theme', default='default', help="Theme to use")
+
+    run = argparse.ArgumentParser(add_help=False)
+    run.add_argument('--repeat', type=int, default=3, help="Report the best of this many runs")
+    run.add_argument('--json', metavar='FILE', help="Write the results to a JSON file")
+
+    replay = argparse.ArgumentParser(add_help=False, parents=[events, layout])
+    replay.add_argument('-e', '--events', help="Use this recording instead of synthetic events; "
+                        "--duration must not exceed its length")
+    replay.add_argument('--scale', type=float, default=1.0, help="Scale the overlay by the given value")
+    replay.add_argument('-r', '--fps', type=int, default=60, help="Framerate of the overlay")
+    replay.add_argument('-U', '--unpremultiply-backend', default='ffmpeg', dest='backend',
+                        choices=('numpy', 'ffmpeg'),
+                        help="Unpremultiply in save_frame with numpy, or not at all (ffmpeg, default)")
+
+    p = subparsers.add_parser('generate', parents=[events], help="Write a synthetic event recording")
+    p.set_defaults(func=generate, parser=p)
+    p.add_argument('-o', '--output', default='-', help="Output file (default: stdout)")
+
+    p = subparsers.add_parser('parse', parents=[replay, run], help="Measure event parsing")
+    p.set_defaults(func=bench_parse, parser=p)
+
+    p = subparsers.add_parser('render', parents=[replay, run],
+                              help="Measure update, draw and save_frame into a null sink")
+    p.set_defaults(func=bench_render, parser=p)
+
+    p = subparsers.add_parser('all', parents=[replay, run], help="Run parse and render")
+    p.set_defaults(func=bench_all, parser=p)
+
+    p = subparsers.add_parser('unpremultiply', parents=[layout, run],
+                              help="Compare the unpremultiply backends")
+    p.set_defaults(func=bench_unpremultiply, parser=p)
+    p.add_argument('--scales', default=[1.0, 2.0],
+                   type=lambda s: [float(v) for v in s.split(",")],
+                   help="Comma separated overlay scales to test (default: 1,2)")
+    p.add_argument('-n', '--frames', type=int, default=600, help="Number of frames per run")
+    p.add_argument('--partial', type=float, default=.05,
+                   help="Fraction of semi-transparent pixels (default: 0.05)")
+    p.add_argument('-b', '--backends', default=['external', 'numpy', 'ffmpeg', 'ffmpeg-null'],
+                   type=lambda s: s.split(","), help="Comma separated backends to run")
+    p.add_argument('--unpremultiply', default="unpremultiply", help="Command name of unpremultiply")
+    p.add_argument('--ffmpeg', default="ffmpeg", help="Command name of ffmpeg")
+
+    p = subparsers.add_parser('compare', help="Compare two JSON result files")
+    p.set_defaults(func=compare, parser=p)
+    p.add_argument('old', help="Results of the baseline run")
+    p.add_argument('new', help="Results to compare")
+    p.add_argument('--threshold', type=float, default=.05,
+                   help="Relative change reported as faster or slower (default: 0.05)")
+
+    args = parser.parse_args(argv)
+    if args.func in (generate, compare):
+        return args.func(args)
+
+    params = {k: v for k, v in vars(args).items()
+              if k not in ('func', 'parser', 'json', 'bench')}
+    results = Results(dict(params, bench=args.bench))
+    args.func(args, results)
+    if args.json is not None:
+        results.dump(args.json)
+    return 0
+
+
+if __name__ == '__main__':
+    from common import run_main
+    run_main(main)
+
+
+# vim:set sw=4 ts=8 sts=4 et sr ft=python fdm=marker tw=0:
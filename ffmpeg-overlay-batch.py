@@ -0,0 +1,208 @@
+#!/usr/bin/python
+# File:        ffmpeg-overlay-batch.py
+# Description: render the overlays of many recordings
+# Created:     2026-10-17
+
+"""Run many ffmpeg-overlay.py jobs from a manifest on a pool of processes.
+
+The manifest is a JSON list of jobs, or an object with a "jobs" list and
+"defaults" applied to every job. Each job is an object with these keys:
+
+    events      event file (required)
+    template    ffmpeg command template as list, see ffmpeg-overlay.py;
+                "{video}" and "{output}" are replaced with the values of
+                these keys
+    video       main video, for the template
+    output      output file, for the template
+    delay, start, absolute_start, duration, until
+                seconds, as the options of ffmpeg-overlay.py
+    type, layout, theme, fps, scale, position
+                as the options of ffmpeg-overlay.py
+    args        list of further ffmpeg-overlay.py options
+    log         file receiving the output of ffmpeg and the job
+    name        name in the report (default: the output or events file)
+
+Each worker process imports the configuration once and keeps cairo's font
+caches warm across its jobs."""
+
+import os
+import sys
+import json
+import time
+import argparse
+from common import ArgvError
+
+
+DEFAULT_TEMPLATE = ["ffmpeg", "-nostdin", "-y", "-i", "{video}", "{overlay}",
+                    "-c:a", "copy", "{output}"]
+
+OPTIONS = (
+    ('events', '-e'),
+    ('delay', '-d'),
+    ('start', '-s'),
+    ('absolute_start', '-S'),
+    ('duration', '--duration'),
+    ('until', '--until'),
+    ('type', '-t'),
+    ('layout', '-l'),
+    ('theme', '-T'),
+    ('fps', '-r'),
+    ('scale', '--scale'),
+    ('position', '-p'),
+)
+
+
+def load_manifest(path):
+    with open(path) as f:
+        manifest = json.load(f)
+    if isinstance(manifest, list):
+        manifest = {'jobs': manifest}
+    defaults = manifest.get('defaults', {})
+    jobs = []
+    for job in manifest['jobs']:
+        merged = dict(defaults)
+        merged.update(job)
+        if 'events' not in merged:
+            raise ValueError("job without events: %r" % (job,))
+        merged.setdefault('name', merged.get('output', merged['events']))
+        jobs.append(merged)
+    return jobs
+
+
+def job_argv(job):
+    """Return the ffmpeg-overlay.py command line of job."""
+    argv = ['ffmpeg-overlay.py']
+    for key, option in OPTIONS:
+        if job.get(key) is not None:
+            argv += [option, str(job[key])]
+    argv += job.get('args', [])
+    argv.append('--')
+    for arg in job.get('template', DEFAULT_TEMPLATE):
+        if arg == '{video}':
+            arg = job['video']
+        elif arg == '{output}':
+            arg = job['output']
+        argv.append(arg)
+    return argv
+
+
+_overlay = None
+
+def _init_worker():
+    global _overlay
+    import importlib.util
+    import overlayapi as api
+    # Jobs run side by side, ffmpeg must not read the terminal.
+    sys.stdin = open(os.devnull)
+    os.dup2(sys.stdin.fileno(), 0)
+    # Import ffmpeg-overlay.py under a name, so -j can pickle its functions.
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ffmpeg-overlay.py')
+    spec = importlib.util.spec_from_file_location('ffmpeg_overlay', path)
+    _overlay = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = _overlay
+    spec.loader.exec_module(_overlay)
+    api.import_all_config()
+
+
+def _run_job(job):
+    import contextlib
+    result = {'name': job['name'], 'status': None, 'frames': 0, 'error': None}
+    start = time.perf_counter()
+    with contextlib.ExitStack() as stack:
+        if job.get('log'):
+            log = stack.enter_context(open(job['log'], 'w'))
+            stack.enter_context(contextlib.redirect_stdout(log))
+            stack.enter_context(contextlib.redirect_stderr(log))
+        try:
+            layoutcls, ctype, theme, args = _overlay.parse_args(job_argv(job))
+            writer, anim = _overlay.render(layoutcls, ctype, theme, args)
+            result['status'] = writer.exit_status
+            result['frames'] = anim.frames
+            if writer.exit_status != 0:
+                result['error'] = "ffmpeg exited with status %d" % (writer.exit_status,)
+        except ArgvError as e:
+            result['error'] = "invalid job: %s" % (e,)
+        except SystemExit as e:
+            # argparse rejected the options
+            result['error'] = "invalid job (status %s)" % (e.code,)
+        except Exception as e:
+            result['error'] = "%s: %s" % (type(e).__name__, e)
+    result['elapsed'] = time.perf_counter() - start
+    return result
+
+
+def format_result(result):
+    elapsed = result['elapsed']
+    fps = result['frames'] / elapsed if elapsed > 0 else 0.0
+    if result['error'] is None:
+        return ("%s: %d frames in %.1f s, %.1f frames/s"
+                % (result['name'], result['frames'], elapsed, fps))
+    return "%s: FAILED after %.1f s: %s" % (result['name'], elapsed, result['error'])
+
+
+def main(argv):
+    progname = argv.pop(0).rpartition('/')[2]
+
+    parser = argparse.ArgumentParser(prog=progname, description="""
+    Render the overlays of all jobs in a JSON manifest, running a bounded
+    number of jobs at once.""")
+    parser.add_argument('manifest', help="JSON job list")
+    parser.add_argument('-P', '--processes', type=int, default=None,
+                        help="Number of jobs run at once (default: number of CPUs)")
+    parser.add_argument('--json', default=None, metavar="FILE",
+                        help="Write the results of all jobs to the given JSON file")
+    args = parser.parse_args(argv)
+
+    try:
+        jobs = load_manifest(args.manifest)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        raise ArgvError("cannot read manifest: %s" % (e,), parser)
+    processes = args.processes
+    if processes is None:
+        processes = len(os.sched_getaffinity(0))
+    elif processes < 1:
+        raise ArgvError("invalid number of processes: %d" % (processes,), parser)
+    processes = min(processes, len(jobs)) or 1
+
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    start = time.perf_counter()
+    results = []
+    # Workers are not daemonic, so jobs may use -j themselves.
+    with ProcessPoolExecutor(processes, multiprocessing.get_context('fork'),
+                             initializer=_init_worker) as pool:
+        futures = {pool.submit(_run_job, job): job for job in jobs}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                # the worker died
+                job = futures[future]
+                result = {'name': job['name'], 'status': None, 'frames': 0,
+                          'error': "%s: %s" % (type(e).__name__, e), 'elapsed': 0.0}
+            results.append(result)
+            print("[%d/%d] %s" % (len(results), len(jobs), format_result(result)),
+                  file=sys.stderr)
+    elapsed = time.perf_counter() - start
+
+    failed = [r for r in results if r['error'] is not None]
+    frames = sum(r['frames'] for r in results)
+    print("%d jobs, %d failed, %d frames in %.1f s, %.1f frames/s on %d processes"
+          % (len(results), len(failed), frames, elapsed,
+             frames / elapsed if elapsed > 0 else 0.0, processes), file=sys.stderr)
+    for result in failed:
+        print("failed: " + format_result(result), file=sys.stderr)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'elapsed': elapsed, 'processes': processes,
+                       'jobs': results}, f, indent=2)
+            f.write("\n")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    from common import run_main
+    run_main(main)
+
+
+# vim:set sw=4 ts=8 sts=4 et sr ft=python fdm=marker tw=0:
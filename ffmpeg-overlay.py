@@ -6,28 +6,176 @@ import os
 import contextlib
 import overlayapi as api
 import js
+import nut
 from overlayapi import Context, ControlsAnimation
 from common import ArgvError
 
 
+def clear_surface(cctx, background=None):
+    with cctx:
+        if background is None:
+            cctx.set_source_rgba(0, 0, 0, 0)
+        else:
+            cctx.identity_matrix()
+            cctx.set_source_surface(background, 0, 0)
+        cctx.set_operator(cairo.OPERATOR_SOURCE)
+        cctx.paint()
+
+
+def draw_background(surface, cctx, anim):
+    """Render the static background of anim for use with clear_surface."""
+    background = cairo.ImageSurface(cairo.FORMAT_ARGB32,
+                                    surface.get_width(), surface.get_height())
+    bgctx = cairo.Context(background)
+    bgctx.set_matrix(cctx.get_matrix())
+    anim.draw_background(bgctx)
+    background.flush()
+    return background
+
+
+# ffmpeg options that take no value
+FFMPEG_FLAGS = frozenset((
+    '-y', '-n', '-stdin', '-nostdin', '-hide_banner', '-re', '-an', '-vn',
+    '-sn', '-dn', '-shortest', '-stats', '-nostats', '-copyts',
+    '-start_at_zero', '-benchmark', '-benchmark_all', '-accurate_seek',
+    '-autorotate', '-autoscale', '-copyinkf', '-debug_ts', '-dump', '-hex',
+    '-ignore_unknown', '-copy_unknown', '-xerror', '-fix_sub_duration',
+))
+
+
+def count_inputs(args):
+    """Return the number of input files of the ffmpeg command line args."""
+    count = 0
+    value = False
+    for arg in args[1:]:
+        if value:
+            value = False
+        elif arg == '-i':
+            count += 1
+            value = True
+        elif arg.startswith('-') and len(arg) > 1:
+            # boolean options can be negated with a "no" prefix
+            value = arg not in FFMPEG_FLAGS and not arg.startswith('-no')
+    return count
+
+
+def get_converter(backend):
+    """Return the function that unpremultiplies frames in-process, if any."""
+    if backend == 'numpy':
+        from unpremultiply import unpremultiply
+        return unpremultiply
+    elif backend in ('external', 'ffmpeg'):
+        return None
+    raise ValueError("unknown unpremultiply backend: %r" % (backend,))
+
+
+class FdStream(object):
+
+    """Unbuffered output to a file descriptor.
+
+    Buffers are written directly, without copying them in userspace."""
+
+    def __init__(self, fd):
+        self.fd = fd
+        try:
+            self.iov_max = os.sysconf('SC_IOV_MAX')
+        except (ValueError, OSError):
+            self.iov_max = 1024
+
+    def fileno(self):
+        return self.fd
+
+    def grow(self, size):
+        """Try to make the pipe hold at least size bytes."""
+        import fcntl
+        try:
+            with open('/proc/sys/fs/pipe-max-size') as f:
+                size = min(size, int(f.read()))
+            fcntl.fcntl(self.fd, fcntl.F_SETPIPE_SZ, size)
+        except (AttributeError, OSError, ValueError):
+            # not a pipe, or not supported on this platform
+            pass
+
+    def write(self, data):
+        view = memoryview(data).cast('B')
+        while view:
+            view = view[os.write(self.fd, view):]
+
+    def writev(self, buffers):
+        """Write all buffers with as few system calls as possible."""
+        views = [memoryview(b).cast('B') for b in buffers]
+        iov_max = self.iov_max
+        while views:
+            written = os.writev(self.fd, views[:iov_max])
+            # drop what was written, continue in the middle of a buffer
+            i = 0
+            while i < len(views) and written >= len(views[i]):
+                written -= len(views[i])
+                i += 1
+            del views[:i]
+            if views and written:
+                views[0] = views[0][written:]
+
+    def write_repeated(self, data, count):
+        self.writev([data] * count)
+
+    def close(self):
+        fd, self.fd = self.fd, None
+        if fd is not None:
+            os.close(fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
 class FFMpegWriter(object):
 
     def __init__(self, surface, cctx, templateargs, position=(.5, 1.0),
-                 fps=30, unpremultiply="unpremultiply"):
+                 fps=30, unpremultiply="unpremultiply", vfr=False,
+                 backend="external", hold_last_frame=False, queue_frames=0):
         self.surface = surface
         self.cctx = cctx
         self.templateargs = templateargs
         self.position = position
         self.fps = fps
         self.unpremultiply = unpremultiply
+        self.vfr = vfr
+        self.backend = backend
+        self.hold_last_frame = hold_last_frame
+        self.queue_frames = queue_frames
+        if vfr and backend == 'external':
+            raise ValueError("NUT stream cannot go through the unpremultiply filter")
+        self.convert = get_converter(backend)
 
         self.frame_size = (surface.get_width(), surface.get_height())
         self.frame_format = "bgra"
+        self.keep_last_frame = False
+        self.background = None
+        self.stats = api.NO_STATS
+        self._last_frame = None
+        self._frame_index = 0
+        self._thread = None
+        self._error = None
+        self._error_raised = False
+        # records the frames written, see rendercache
+        self.recorder = None
+        # called with the writer once it is set up
+        self.prelude = None
+
+    @property
+    def holds_last_frame(self):
+        """Whether ffmpeg keeps showing the last frame after our stream ends."""
+        return self.vfr or self.hold_last_frame
 
     @contextlib.contextmanager
     def saving(self):
         self.setup()
         try:
+            if self.prelude is not None:
+                self.prelude(self)
             yield
         except BrokenPipeError:
             raise
@@ -42,6 +190,79 @@ class FFMpegWriter(object):
 
     def setup(self):
         self._run()
+        if self.vfr:
+            width, height = self.frame_size
+            self._muxer = nut.NutMuxer(self._stream, width, height, self.fps)
+            self._muxer.write_header()
+        if self.queue_frames > 0:
+            self._start_thread()
+
+    def _start_thread(self):
+        # Frames are copied into pooled buffers and written by a thread,
+        # while the next frame is drawn. Writing to the pipe, cairo and
+        # numpy release the GIL.
+        import threading
+        import queue
+        self._queue = queue.Queue(self.queue_frames)
+        self._free = queue.Queue()
+        size = len(memoryview(self.surface.get_data()))
+        # one more buffer is drawn into, another is held as last frame
+        for _ in range(self.queue_frames + 2):
+            self._free.put(bytearray(size))
+        if self.stats is api.NO_STATS:
+            self._thread_stats = api.NO_STATS
+        else:
+            self._thread_stats = api.RenderStats()
+        self._thread = threading.Thread(target=self._write_thread,
+                                        name="frame writer", daemon=True)
+        self._thread.start()
+
+    def _write_thread(self):
+        get = self._queue.get
+        free = self._free.put
+        stats = self._thread_stats
+        while True:
+            item = get()
+            if item is None:
+                return
+            data, count, convert = item
+            previous = self._last_frame
+            if self._error is None:
+                stats.mark()
+                try:
+                    if data is None:
+                        self._repeat_frame(count, stats)
+                    else:
+                        if convert:
+                            self._convert(data, stats)
+                        self._write_frame(data, stats, owned=True)
+                except Exception as e:
+                    self._error = e
+            # Hand back the buffers that are no longer the last frame.
+            last = self._last_frame
+            if previous is not last and isinstance(previous, bytearray):
+                free(previous)
+            if data is not last and isinstance(data, bytearray):
+                free(data)
+
+    def _enqueue(self, item):
+        if self._error is not None:
+            self._error_raised = True
+            raise self._error
+        queue = self._queue
+        self.stats.queued(queue.qsize(), self.queue_frames)
+        queue.put(item)
+        self.stats.lap('queue')
+
+    def _stop_thread(self):
+        thread = self._thread
+        if thread is None:
+            return
+        self._thread = None
+        self._queue.put(None)
+        thread.join()
+        if self._thread_stats is not api.NO_STATS:
+            self.stats.merge(self._thread_stats, prefix="writer ")
 
     def _run(self):
         import subprocess
@@ -55,10 +276,25 @@ class FFMpegWriter(object):
             ffenv = dict(os.environ)
             ffenv['FFMPEG_OVERLAY_FDS'] = ','.join(str(fd) for fd in pass_fds)
             command = self._args(pread)
-            self._proc_filter = subprocess.Popen((self.unpremultiply,), shell=False,
-                                                stdin=subprocess.PIPE,
-                                                stdout=pwrite,
-                                                stderr=sys.stderr)
+            if self.backend == 'external':
+                fread, fwrite = os.pipe()
+                try:
+                    self._proc_filter = subprocess.Popen((self.unpremultiply,), shell=False,
+                                                        stdin=fread,
+                                                        stdout=pwrite,
+                                                        stderr=sys.stderr)
+                except:
+                    os.close(fwrite)
+                    raise
+                finally:
+                    os.close(fread)
+                self._stream = FdStream(fwrite)
+            else:
+                self._proc_filter = None
+                self._stream = FdStream(os.dup(pwrite))
+            # room for a few frames, so we can draw while ffmpeg reads
+            width, height = self.frame_size
+            self._stream.grow(width * height * 4 * 2)
             self._proc_ff = subprocess.Popen(command, shell=False,
                                             pass_fds=pass_fds,
                                             env=ffenv,
@@ -68,42 +304,134 @@ class FFMpegWriter(object):
         finally:
             os.close(pread)
             os.close(pwrite)
-        self._stream = self._proc_filter.stdin
 
     def _args(self, pread):
         args = []
         haveinput = False
+        inputindex = None
         for arg in self.templateargs:
             if arg.startswith("{{") and arg.endswith("}}"):
                 args.append(arg[1:-1])
             elif arg in ('{overlay}', '{overlayin}', '{overlayfilter}'):
                 if arg in ('{overlay}', '{overlayin}'):
-                    args += ['-f', 'rawvideo', '-vcodec', 'rawvideo',
-                             '-s', '%dx%d' % self.frame_size, '-pix_fmt',
-                             self.frame_format, '-r', str(self.fps), '-i', 'pipe:%s' % (pread,)]
+                    inputindex = count_inputs(args)
+                    if self.vfr:
+                        args += ['-f', 'nut', '-i', 'pipe:%s' % (pread,)]
+                    else:
+                        args += ['-f', 'rawvideo', '-vcodec', 'rawvideo',
+                                 '-s', '%dx%d' % self.frame_size, '-pix_fmt',
+                                 self.frame_format, '-r', str(self.fps), '-i', 'pipe:%s' % (pread,)]
                     haveinput = True
                 if arg in ('{overlay}', '{overlayfilter}'):
-                    pos = self.position
-                    args += ['-lavfi',
-                             'overlay=(W-w)*{left}:(H-h)*{top}:shortest=1'.format(
-                             left=pos[0], top=pos[1])]
+                    args += ['-lavfi', self._filter(inputindex)]
             else:
                 args.append(arg)
         if not haveinput:
             raise ValueError("no overlay placeholder found")
         return args
 
+    def _filter(self, inputindex):
+        pos = self.position
+        overlay = 'overlay=(W-w)*{left}:(H-h)*{top}'.format(left=pos[0], top=pos[1])
+        if not self.holds_last_frame and self.backend != 'ffmpeg':
+            return overlay + ':shortest=1'
+        if inputindex is None:
+            raise ValueError("{overlayfilter} must follow {overlayin}")
+        steps = []
+        if self.backend == 'ffmpeg':
+            steps.append('unpremultiply=inplace=1')
+        if self.holds_last_frame:
+            # The overlay stream ends with the last change. Repeat that
+            # frame without end, the main video determines the length.
+            steps.append('tpad=stop=-1:stop_mode=clone')
+        return '[{index}:v]{steps}[ovl];[0:v][ovl]{overlay}:shortest=1'.format(
+            index=inputindex, steps=','.join(steps), overlay=overlay)
+
+    def _convert(self, data, stats=None):
+        convert = self.convert
+        if convert is not None:
+            convert(data)
+            (stats or self.stats).lap('convert')
+        return data
+
     def save_frame(self):
         surface = self.surface
         cctx = self.cctx
+        stats = self.stats
         surface.flush()
-        self._stream.write(surface.get_data())
-        with cctx:
-            cctx.set_source_rgba(0, 0, 0, 0)
-            cctx.set_operator(cairo.OPERATOR_SOURCE)
-            cctx.paint()
+        data = surface.get_data()
+        stats.lap('fetch')
+        if self._thread is not None:
+            buffer = self._free.get()
+            buffer[:] = data
+            stats.add_copied(len(buffer))
+            stats.lap('copy')
+            self._enqueue((buffer, 1, True))
+        else:
+            self.write_frame(self._convert(data))
+        clear_surface(cctx, self.background)
+        stats.lap('clear')
+
+    def cache_background(self, anim):
+        self.background = draw_background(self.surface, self.cctx, anim)
+        clear_surface(self.cctx, self.background)
+
+    def write_frame(self, data):
+        if self._thread is not None:
+            self._enqueue((data, 1, False))
+        else:
+            self._write_frame(data, self.stats)
+
+    def _write_frame(self, data, stats, owned=False):
+        # owned: data is not changed afterwards and can be kept as is
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.frame(data)
+            stats.lap('cache')
+        if self.vfr:
+            # Only send frames that differ from the last one sent.
+            last = self._last_frame
+            if last is None or memoryview(data) != last:
+                if not owned:
+                    data = bytes(data)
+                    stats.add_copied(len(data))
+                self._last_frame = data
+                stats.lap('compare')
+                self._muxer.write_frame(self._frame_index, self._last_frame)
+                stats.add_bytes(len(self._last_frame))
+        else:
+            if self.keep_last_frame:
+                if not owned:
+                    data = bytes(data)
+                    stats.add_copied(len(data))
+                self._last_frame = data
+            self._stream.write(data)
+            stats.add_bytes(len(data))
+        stats.lap('write')
+        self._frame_index += 1
+
+    def repeat_frame(self, count=1):
+        """Write the previously saved frame count more times without drawing.
+
+        Requires keep_last_frame to be set before saving that frame."""
+        if self._thread is not None:
+            self._enqueue((None, count, False))
+        else:
+            self._repeat_frame(count, self.stats)
+
+    def _repeat_frame(self, count, stats):
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.repeat(count)
+        if not self.vfr:
+            data = self._last_frame
+            self._stream.write_repeated(data, count)
+            stats.add_bytes(len(data) * count)
+            stats.lap('write')
+        self._frame_index += count
 
     def wait(self):
+        self._stop_thread()
         try:
             self._stream.close()
         except BrokenPipeError:
@@ -115,11 +443,162 @@ class FFMpegWriter(object):
             try:
                 status = proc.wait()
                 self.exit_status = status
-                return status
+                break
             except KeyboardInterrupt:
                 # ffmpeg receives these signals and exits at some point,
                 # just keep waiting
                 pass
+        if self._error is not None and not self._error_raised:
+            # the writer thread failed on one of the last frames
+            self._error_raised = True
+            raise self._error
+        return status
+
+
+class FrameBuffer(object):
+
+    """Writer that collects the frames of one segment in memory.
+
+    Repeated frames are stored as None."""
+
+    keep_last_frame = False
+    background = None
+    stats = api.NO_STATS
+
+    def __init__(self, surface, cctx, holds_last_frame=False, convert=None):
+        self.surface = surface
+        self.cctx = cctx
+        self.holds_last_frame = holds_last_frame
+        self.convert = convert
+        self.frames = []
+
+    def save_frame(self):
+        surface = self.surface
+        stats = self.stats
+        surface.flush()
+        data = surface.get_data()
+        stats.lap('fetch')
+        data = bytes(self._convert(data))
+        stats.add_copied(len(data))
+        self.frames.append(data)
+        clear_surface(self.cctx, self.background)
+        stats.lap('clear')
+
+    cache_background = FFMpegWriter.cache_background
+    _convert = FFMpegWriter._convert
+
+    def repeat_frame(self, count=1):
+        self.frames.extend([None] * count)
+
+
+_worker = None
+
+def _init_worker(args, holds_last_frame, convert):
+    global _worker
+    import signal
+    # The main process handles interrupts and terminates the pool.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    ctype = api.CONTROLLER_TYPES[args.type]()
+    layout = api.LAYOUTS[args.layout](ctype)
+    theme = api.THEMES[args.theme]()
+    surface, cctx = create_surface(layout, args.scale)
+    anim = create_animation(args, layout, ctype, theme,
+                            js.open_events(args.events))
+    anim.init()
+    buffer = FrameBuffer(surface, cctx, holds_last_frame, convert)
+    if anim.cache_background:
+        buffer.cache_background(anim)
+    _worker = anim, buffer
+
+def _render_segment(start, stop, collect_stats):
+    anim, buffer = _worker
+    if collect_stats:
+        anim.stats = buffer.stats = stats = api.RenderStats()
+    else:
+        stats = None
+    anim.seek(start)
+    buffer.frames = []
+    cache = anim.sprite_cache
+    if cache is not None:
+        before = cache.counters()
+    finished = anim.render(buffer, start, stop)
+    if cache is not None:
+        counters = tuple(a - b for a, b in zip(cache.counters(), before))
+    else:
+        counters = None
+    return buffer.frames, finished, counters, stats
+
+
+class ParallelRenderer(object):
+
+    """Render the animation in segments on several worker processes.
+
+    Each worker restores the state at the start of its segments, so the
+    frames written are identical to those of ControlsAnimation.save."""
+
+    def __init__(self, anim, args, jobs, segment_frames):
+        self.anim = anim
+        self.args = args
+        self.jobs = jobs
+        self.segment_frames = segment_frames
+
+    def save(self, writer, stop=None, stats=None, start=0):
+        """Render the segments from start until stop to writer.
+
+        Raises BrokenProcessPool if a worker dies or fails to start."""
+        import multiprocessing
+        from collections import deque
+        from concurrent.futures import ProcessPoolExecutor
+        if stats is not None:
+            writer.stats = stats
+        writer.keep_last_frame = True
+        mp = multiprocessing.get_context('fork')
+        # Shutting down the pool waits for the segments being rendered.
+        with ProcessPoolExecutor(self.jobs, mp, initializer=_init_worker,
+                                 initargs=(self.args, writer.holds_last_frame,
+                                           writer.convert)) as pool:
+            # The workers start with the first task. Start them before
+            # ffmpeg so they do not inherit the pipe to it.
+            pool.submit(int).result()
+            with writer.saving():
+                pending = deque()
+                try:
+                    self._write_segments(pool, writer, pending, start, stop, stats)
+                finally:
+                    for future in pending:
+                        future.cancel()
+
+    def _write_segments(self, pool, writer, pending, start, stop, stats):
+        anim = self.anim
+        while True:
+            while len(pending) < self.jobs * 2 and start != stop:
+                end = start + self.segment_frames
+                if stop is not None:
+                    end = min(end, stop)
+                pending.append(pool.submit(_render_segment,
+                                           start, end, stats is not None))
+                start = end
+            if not pending:
+                return
+            if stats is not None:
+                stats.mark()
+            frames, finished, counters, segment_stats = pending.popleft().result()
+            if stats is not None:
+                stats.lap('wait')
+                # Stage times are summed over all workers, frame times
+                # are those of the workers.
+                stats.merge(segment_stats)
+            if counters is not None:
+                anim.sprite_cache.add_counters(counters)
+            for data in frames:
+                if data is None:
+                    writer.repeat_frame()
+                    anim.reused_frames += 1
+                else:
+                    writer.write_frame(data)
+                anim.frames += 1
+            if finished:
+                return
 
 
 def convert_timearg(s):
@@ -150,20 +629,58 @@ def parse_args(argv):
     All occurrences of {ss} are replaced with the value of the --start option
     in ffmpeg-compatible time format. If no --start option is given, 0 is used.
     """)
-    parser.add_argument('-e', '--events', help="jstest --event output file")
+    parser.add_argument('-e', '--events', help="jstest --event output file, or binary events from js-pack.py")
     parser.add_argument('-d', '--delay', default=None,
                         help="Additional delay for events in seconds (float)")
     parser.add_argument('-s', '-ss', '--start', default=None, dest='start',
                         help="Skip given amount of time of events, in seconds. For use with ffmpeg -ss option")
     parser.add_argument('-S', '--absolute-start', default=None, dest='absolute_start',
                         help="Absolute start time within events")
+    parser.add_argument('--no-seek-index', action='store_false', dest='seek_index',
+                        help="Do not create or use the seek index next to the events file")
     parser.add_argument('-t', '--type', default='auto', help="Specify the controller type to use")
     parser.add_argument('-l', '--layout', default='distance', help="Name of the layout to use")
     parser.add_argument('-T', '--theme', default='default', help="Specify the theme to use")
     parser.add_argument('--scale', type=float, default=1.0, help="Scale the overlay by the given value")
+    parser.add_argument('--duration', default=None,
+                        help="Stop the overlay after the given number of seconds (float)")
+    parser.add_argument('--until', default=None,
+                        help="Stop the overlay at the given position of the main video in seconds (float)")
+    parser.add_argument('--auto-stop', action='store_true',
+                        help="Stop after the last event when nothing animates anymore")
     parser.add_argument('-r', '--fps', type=int, default=60, help="Framerate at which the overlay is generated")
     parser.add_argument('-p', '--position', default="1.0,0.8", metavar="LEFT,TOP", help="Relative position of the overlay, values between 0.0 and 1.0")
     parser.add_argument('--unpremultiply', default="unpremultiply", help="Override the command name of unpremultiply")
+    parser.add_argument('-U', '--unpremultiply-backend', default=None, dest='backend',
+                        choices=('external', 'numpy', 'ffmpeg'),
+                        help="Unpremultiply frames with the external program (default), "
+                             "in-process with numpy, or in ffmpeg's filter graph "
+                             "(default with --vfr)")
+    parser.add_argument('--dedup', action='store_true',
+                        help="Reuse the previous frame if no control changed, skip updates until the next event")
+    parser.add_argument('--sprite-cache', type=float, default=None, metavar="MB",
+                        help="Cache pre-rendered controls using up to the given memory per process")
+    parser.add_argument('--label-masks', action='store_true',
+                        help="Composite labels from masks rendered once instead of drawing their text every frame")
+    parser.add_argument('--cache-background', action='store_true',
+                        help="Draw the static parts of always visible controls only once, "
+                             "unless they overlap controls drawn before them")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="Render on the given number of processes")
+    parser.add_argument('--write-queue', type=int, default=0, metavar="FRAMES",
+                        help="Write frames on a separate thread, queueing up to the given number of frames")
+    parser.add_argument('--timeline', action='store_true',
+                        help="Compute the control values of a minute of frames at once (requires numpy)")
+    parser.add_argument('--render-cache', default=None, metavar="DIR",
+                        help="Replay the overlay from the given cache directory if it was "
+                             "rendered before with the same events and options, store it otherwise")
+    parser.add_argument('--render-cache-size', type=float, default=4096, metavar="MB",
+                        help="Remove the least recently used entries when the cache gets "
+                             "larger (default: %(default)s)")
+    parser.add_argument('--stats', action='store_true',
+                        help="Print where the time went at exit")
+    parser.add_argument('--stats-json', default=None, metavar="FILE",
+                        help="Write the statistics to the given JSON file")
+    parser.add_argument('--vfr', action='store_true', help="Send the overlay as timestamped NUT stream, only when it changes")
 
     args = parser.parse_args(argv)
 
@@ -171,6 +688,18 @@ def parse_args(argv):
 
     args.delay = convert_timearg(args.delay)
     args.start = convert_timearg(args.start)
+    if args.duration is not None and args.until is not None:
+        raise ArgvError("--duration and --until are mutually exclusive", parser)
+    if args.until is not None:
+        args.duration = convert_timearg(args.until) - args.start
+    elif args.duration is not None:
+        args.duration = convert_timearg(args.duration)
+    if args.duration is not None:
+        if args.duration <= 0:
+            raise ArgvError("overlay ends before it starts", parser)
+        args.stop_frame = -(-args.duration * args.fps // 1000)
+    else:
+        args.stop_frame = None
     if args.absolute_start is not None:
         args.absstart = int(args.absolute_start)
     else:
@@ -189,6 +718,17 @@ def parse_args(argv):
     except KeyError:
         raise ArgvError("no such theme: %s" % (args.theme,), parser)
 
+    if args.jobs > 1 and args.events in (None, '-'):
+        raise ArgvError("--jobs cannot read events from stdin", parser)
+
+    if args.write_queue < 0:
+        raise ArgvError("invalid --write-queue: %d" % (args.write_queue,), parser)
+
+    if args.backend is None:
+        args.backend = 'ffmpeg' if args.vfr else 'external'
+    elif args.backend == 'external' and args.vfr:
+        raise ArgvError("--vfr cannot use the external unpremultiply program", parser)
+
     left, sep, top = args.position.partition(",")
     if sep == "":
         raise ArgvError("invalid position: %s" % (args.position,), parser)
@@ -213,25 +753,150 @@ def create_surface(layout, scale):
     return img, cctx
 
 
-def main(argv):
-    layoutcls, ctype, theme, args = parse_args(argv)
+def create_animation(args, layout, ctype, theme, source):
+    evs = js.HandlerJsEvents(source)
+    evs.seek_index = args.seek_index
+    context = Context(theme, ctype, evs)
+    context.init_time(args.start - args.delay, absstart=args.absstart)
+    if args.sprite_cache:
+        sprite_cache = api.SpriteCache(cairo, int(args.sprite_cache * 2**20))
+    else:
+        sprite_cache = None
+    if args.label_masks:
+        label_masks = api.LabelMaskCache(cairo)
+    else:
+        label_masks = None
+    return ControlsAnimation(context, layout.controls, fps=args.fps,
+                             dedup=args.dedup, sprite_cache=sprite_cache,
+                             cache_background=args.cache_background,
+                             timeline=args.timeline, label_masks=label_masks,
+                             stop=args.stop_frame)
+
+
+def open_render_cache(args, layout, ctype, theme, writer):
+    """Return the render cache and the key of the overlay, or None, None."""
+    import inspect
+    import rendercache
+    if args.events in (None, '-'):
+        print("render cache: not used for events from stdin", file=sys.stderr)
+        return None, None
+    cache = rendercache.RenderCache(args.render_cache,
+                                    int(args.render_cache_size * 2**20))
+    params = {
+        'events': rendercache.file_digest(args.events),
+        'type': args.type, 'layout': args.layout, 'theme': args.theme,
+        'scale': args.scale, 'fps': args.fps, 'start': args.start,
+        'delay': args.delay, 'absstart': args.absstart,
+        'stop_frame': args.stop_frame, 'auto_stop': args.auto_stop,
+        # where the stream ends
+        'vfr': args.vfr, 'holds_last_frame': writer.holds_last_frame,
+        'unpremultiplied': get_converter(args.backend) is not None,
+        'label_masks': args.label_masks,
+        'sprite_cache': bool(args.sprite_cache),
+        'cache_background': args.cache_background,
+        'cairo': cairo.cairo_version_string(),
+    }
+    # parsing, sampling, drawing and converting the frames
+    here = os.path.dirname(os.path.abspath(__file__))
+    sources = [os.path.join(here, name)
+               for name in ('ffmpeg-overlay.py', 'overlayapi.py', 'js.py',
+                            'jsindex.py', 'timeline.py', 'unpremultiply.py')]
+    classes = [type(layout), type(ctype), type(theme)]
+    classes += [type(c.look) for c in layout.controls]
+    sources += [inspect.getsourcefile(cls) for cls in classes]
+    return cache, cache.key(params, sources)
+
+
+def render(layoutcls, ctype, theme, args):
+    """Render the overlay into ffmpeg as configured by parse_args.
+
+    Returns the writer and the animation."""
     layout = layoutcls(ctype)
 
     surface, cctx = create_surface(layout, args.scale)
-    with open(args.events, 'r') as source:
-        context = Context(theme, ctype, js.HandlerJsEvents(source))
-        context.init_time(args.start - args.delay, absstart=args.absstart)
-
-        anim = ControlsAnimation(context, layout.controls, fps=args.fps)
+    with js.open_events(args.events) as source:
+        anim = create_animation(args, layout, ctype, theme, source)
 
         writer = FFMpegWriter(surface, cctx, args.templateargs,
                               position=args.position, fps=args.fps,
-                              unpremultiply=args.unpremultiply)
+                              unpremultiply=args.unpremultiply,
+                              vfr=args.vfr, backend=args.backend,
+                              hold_last_frame=(args.auto_stop
+                                               or args.stop_frame is not None),
+                              queue_frames=args.write_queue)
+        if args.jobs > 1:
+            renderer = ParallelRenderer(anim, args, args.jobs,
+                                        segment_frames=args.fps * 2)
+        else:
+            renderer = anim
+        if args.stats or args.stats_json:
+            stats = api.RenderStats()
+        else:
+            stats = None
+
+        start = 0
+        recorder = None
+        if args.render_cache:
+            cache, key = open_render_cache(args, layout, ctype, theme, writer)
+        else:
+            cache = None
+        if cache is not None:
+            import rendercache
+            entry = cache.lookup(key)
+            if entry is not None:
+                path, complete, start = entry
+                writer.keep_last_frame = True
+                writer.prelude = lambda writer: rendercache.replay(path, writer)
+                print("render cache: replaying %d frames" % (start,), file=sys.stderr)
+                # A complete entry ends where nothing changes anymore. That
+                # is only the end of the overlay if the writer holds its
+                # last frame, otherwise the frames after it are rendered.
+                if complete and writer.holds_last_frame:
+                    renderer = None
+            if renderer is not None:
+                # Partial entries are recorded again with the frames
+                # rendered after them.
+                writer.recorder = recorder = cache.recorder(
+                    key, surface.get_stride() * surface.get_height())
+
+        complete = False
         try:
-            anim.save(writer)
+            if renderer is None:
+                with writer.saving():
+                    pass
+            else:
+                renderer.save(writer, stop=args.stop_frame, stats=stats,
+                              start=start)
+            complete = True
         except BrokenPipeError:
             pass
-        return writer.exit_status
+        except:
+            if recorder is not None:
+                recorder.discard()
+                recorder = None
+            raise
+        finally:
+            if recorder is not None:
+                recorder.close(complete)
+                cache.evict()
+            if stats is not None:
+                if args.stats:
+                    stats.print_report()
+                if args.stats_json:
+                    stats.dump(args.stats_json)
+            if args.dedup:
+                print("reused %d of %d frames" % (anim.reused_frames, anim.frames),
+                      file=sys.stderr)
+            if anim.sprite_cache is not None:
+                print("sprite cache: %d hits, %d misses, %d evictions"
+                      % anim.sprite_cache.counters(), file=sys.stderr)
+    return writer, anim
+
+
+def main(argv):
+    layoutcls, ctype, theme, args = parse_args(argv)
+    writer, anim = render(layoutcls, ctype, theme, args)
+    return writer.exit_status
 
 if __name__ == '__main__':
     from common import run_main
@@ -1,12 +1,22 @@
 #!/usr/bin/python
 
 import js
+import re
 import argparse
 import sys
+from common import ArgvError
 
 
-def print_event(ty, type, time, num, value):
-    print("%s: type %d, time %d, number %d, value %d" % (ty, type, time, num, value))
+HEADER = "jsevents modified with js-cut.py"
+# bytes copied at once by the fast cut
+BLOCK_SIZE = 1 << 20
+# a line as split by universal newlines
+LINE_PIECE = re.compile(rb"[^\r\n]*(?:\r\n|\r|\n)|[^\r\n]+")
+
+
+def print_event(ty, type, time, num, value, file=None):
+    print("%s: type %d, time %d, number %d, value %d" % (ty, type, time, num, value),
+          file=file)
 
 
 class PrintHandler(js.Handler):
@@ -22,25 +32,248 @@ def convert_timearg(s, default=None):
         return default
 
 
-def print_start(allstates, starttime):
-    for k, v in allstates.states.items():
+def print_start(states, starttime, file=None):
+    for k, v in states.items():
         type, num = k
         type = type | js.TY_INIT_BIT
-        print_event("Event", type, starttime, num, v)
+        print_event("Event", type, starttime, num, v, file=file)
+
+
+def cut(args, stream, start, until, duration):
+    """Print the events of stream from start until the end time."""
+    evs = js.HandlerJsEvents(stream)
+    evs.seek_index = args.seek_index
+    allstates = js.AllstatesHandler(evs)
+    allstates.attach()
+    evs.ignored_line = print
+
+    print(HEADER)
+    evs.work_all(until='initialized')
+    evs.seek(args.absstart)
+    evs.work_all(until=args.absstart)
+    firsttime = evs.previous_event.time
+    # read until we reach our start time
+    starttime = firsttime + start - args.delay
+    evs.seek(starttime)
+    evs.work_all(until=starttime)
+    print_start(allstates.states, starttime)
+    allstates.remove()
+
+    endtime = None
+    if until is not None:
+        endtime = firsttime + until - args.delay
+    elif duration is not None:
+        endtime = firsttime + duration + start - args.delay
+    PrintHandler(evs).attach()
+    evs.work_all(until=endtime)
+
+
+class TextScanner(object):
+
+    """Read a text recording like JsEvents.work_all, keeping track of byte
+    offsets.
+
+    Keeps the states like AllstatesHandler and collects the other lines.
+    offset is the start of the first line not handled yet."""
+
+    def __init__(self, file, index=None):
+        self.file = file
+        self.index = index
+        self.offset = 0
+        self.handled = 0
+        self.states = {}
+        self.previous = None
+        # event read but not handled yet, and the length of its line
+        self.pending = None
+        self.lines = []
+        # file position after the lines read so far
+        self._position = 0
+        self._pieces = []
+
+    def copy(self):
+        other = TextScanner(self.file, self.index)
+        other.__dict__.update(self.__dict__)
+        other.states = dict(self.states)
+        other.lines = list(self.lines)
+        other._pieces = list(self._pieces)
+        return other
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _next_line(self):
+        pieces = self._pieces
+        if pieces:
+            return pieces.pop()
+        file = self.file
+        file.seek(self._position)
+        raw = file.readline()
+        self._position += len(raw)
+        if b"\r" in raw:
+            pieces.extend(reversed(LINE_PIECE.findall(raw)))
+            return pieces.pop()
+        return raw
+
+    def run(self, until):
+        """Handle events like JsEvents.work_all(until)."""
+        while True:
+            if self.pending is None:
+                raw = self._next_line()
+                if not raw:
+                    return False
+                line = raw.decode('utf-8').rstrip('\r\n')
+                event = js.parse_line(line)
+                if event is None:
+                    self.lines.append(line)
+                    self.offset += len(raw)
+                    continue
+                self.pending = event, len(raw)
+            event, size = self.pending
+            if until == 'initialized':
+                if (event.type & js.TY_INIT_BIT) == 0:
+                    return True
+            elif until is not None and event.time > until:
+                return True
+            self.pending = None
+            self.offset += size
+            self.previous = event
+            self.handled += 1
+            if event.ty == "Event":
+                self.states[(event.type & ~js.TY_INIT_BIT, event.number)] = event.value
+
+    def seek(self, until):
+        """Skip ahead like JsEvents.seek."""
+        if self.index is None:
+            return
+        checkpoint = self.index.find(self.handled, until)
+        if checkpoint is None:
+            return
+        first = self.handled + (self.pending is not None)
+        self.lines.extend(self.index.lines_between(first, checkpoint.count))
+        self.states.clear()
+        self.states.update(checkpoint.states)
+        self.previous = js.parse_line(checkpoint.previous)
+        self.handled = checkpoint.count
+        self.pending = None
+        self.offset = self._position = checkpoint.offset
+        self._pieces = []
+
+
+def copy_range(file, begin, end, out):
+    """Copy the lines from byte offset begin until end (None: the end of
+    the file) to out, with newlines as print writes them."""
+    file.seek(begin)
+    remaining = None if end is None else end - begin
+    carry = b""
+    last = b"\n"
+    while remaining is None or remaining > 0:
+        size = BLOCK_SIZE if remaining is None else min(BLOCK_SIZE, remaining)
+        block = file.read(size)
+        if not block:
+            break
+        if remaining is not None:
+            remaining -= len(block)
+        block = carry + block
+        carry = b""
+        if b"\r" in block:
+            if block.endswith(b"\r"):
+                # may be followed by \n in the next block
+                block = block[:-1]
+                carry = b"\r"
+            block = block.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+        if block:
+            out.write(block)
+            last = block[-1:]
+    if carry:
+        out.write(b"\n")
+    elif last != b"\n":
+        out.write(b"\n")
+
+
+def fast_cut(base, args, start, until, duration, out):
+    """Write the events from start until the end time to the binary stream
+    out, copying them from the file.
+
+    base is a TextScanner at the absolute start time. The output is the
+    same as that of cut()."""
+    import io
+    firsttime = base.previous.time
+    starttime = firsttime + start - args.delay
+    scanner = base.copy()
+    scanner.seek(starttime)
+    scanner.run(starttime)
+
+    endtime = None
+    if until is not None:
+        endtime = firsttime + until - args.delay
+    elif duration is not None:
+        endtime = firsttime + duration + start - args.delay
+    end = None
+    if endtime is not None:
+        tail = scanner.copy()
+        tail.seek(endtime)
+        if tail.run(endtime):
+            end = tail.offset
+
+    text = io.StringIO()
+    print(HEADER, file=text)
+    for line in scanner.lines:
+        print(line, file=text)
+    print_start(scanner.states, starttime, file=text)
+    out.write(text.getvalue().encode('utf-8'))
+    copy_range(base.file, scanner.offset, end, out)
+
+
+def open_scanner(args):
+    """Return a TextScanner at the absolute start time, or None if the
+    events are not a text file."""
+    import jsindex
+    if args.events == '-':
+        return None
+    file = open(args.events, 'rb')
+    if file.peek(len(js.BINARY_MAGIC))[:len(js.BINARY_MAGIC)] == js.BINARY_MAGIC:
+        file.close()
+        return None
+    index = jsindex.get(args.events) if args.seek_index else None
+    scanner = TextScanner(file, index)
+    scanner.run('initialized')
+    scanner.seek(args.absstart)
+    scanner.run(args.absstart)
+    return scanner
 
 
 def main(argv):
     progname = argv.pop(0).rpartition('/')[2]
 
     parser = argparse.ArgumentParser(prog=progname)
+    parser.add_argument('-e', '--events', default='-', help="Text or binary events file (default: stdin)")
     parser.add_argument('-d', '--delay', default=None, help="Additional start delay in seconds")
     parser.add_argument('-s', '-ss', '--start', default=None, help="Start time in seconds (opposite of --delay)")
     parser.add_argument('-S', '--absolute-start', default=None, help="Absolute start time (additional to -s)")
+    parser.add_argument('--no-seek-index', action='store_false', dest='seek_index',
+                        help="Do not create or use the seek index next to the events file")
+    parser.add_argument('--fast', action='store_true',
+                        help="Copy the events of text files instead of parsing and printing them")
+    parser.add_argument('--clip', nargs=3, action='append', default=[],
+                        metavar=('START', 'END', 'FILE'),
+                        help="Write the events from START to END seconds (as -s and -to) to FILE "
+                             "instead of stdout; can be given multiple times")
     endgroup = parser.add_mutually_exclusive_group()
     endgroup.add_argument('-to', '--until', default=None, help="End time in seconds after --delay")
     endgroup.add_argument('-t', '--duration', default=None, help="Duration in seconds after the actual start time")
     args = parser.parse_args(argv)
 
+    if args.clip and (args.start is not None or args.until is not None
+                      or args.duration is not None):
+        raise ArgvError("--clip cannot be combined with --start, --until or --duration", parser)
+    if args.clip and args.events == '-':
+        raise ArgvError("--clip needs an events file", parser)
     args.start = convert_timearg(args.start, 0)
     if args.absolute_start is not None:
         args.absstart = int(args.absolute_start)
@@ -49,33 +282,53 @@ def main(argv):
     args.delay = convert_timearg(args.delay, 0)
     args.until = convert_timearg(args.until, None)
     args.duration = convert_timearg(args.duration, None)
+    try:
+        clips = [(convert_timearg(start), convert_timearg(end), path)
+                 for start, end, path in args.clip]
+    except ValueError as e:
+        raise ArgvError("invalid --clip time: %s" % (e,), parser)
 
-    evs = js.HandlerJsEvents(sys.stdin)
-    allstates = js.AllstatesHandler(evs)
-    allstates.attach()
-    evs.ignored_line = print
+    scanner = None
+    if args.fast or clips:
+        scanner = open_scanner(args)
+        if scanner is None and args.fast:
+            print("%s: --fast needs a text events file, cutting normally" % (progname,),
+                  file=sys.stderr)
 
-    print("jsevents modified with js-cut.py")
-    evs.work_all(until='initialized')
-    evs.work_all(until=args.absstart)
-    firsttime = evs.previous_event.time
-    # read until we reach our start time
-    starttime = firsttime + args.start - args.delay
-    evs.work_all(until=starttime)
-    print_start(allstates, starttime)
-    allstates.remove()
+    # in order of the file, so the reads go forward
+    clips.sort()
+    if scanner is not None:
+        with scanner:
+            if not clips:
+                sys.stdout.flush()
+                fast_cut(scanner, args, args.start, args.until, args.duration,
+                         sys.stdout.buffer)
+            for start, end, path in clips:
+                with open(path, 'wb') as out:
+                    fast_cut(scanner, args, start, end, None, out)
+        return 0
 
-    endtime = None
-    if args.until is not None:
-        endtime = firsttime + args.until - args.delay
-    elif args.duration is not None:
-        endtime = firsttime + args.duration + args.start - args.delay
-    PrintHandler(evs).attach()
-    evs.work_all(until=endtime)
+    with js.open_events(args.events) as stream:
+        if not clips:
+            cut(args, stream, args.start, args.until, args.duration)
+        for start, end, path in clips:
+            import io
+            import contextlib
+            # each clip reads from the start again, seeking with the
+            # index loaded for the first one
+            stream.seek(0)
+            with open(path, 'wb') as out:
+                wrapper = io.TextIOWrapper(out, encoding='utf-8')
+                with contextlib.redirect_stdout(wrapper):
+                    cut(args, stream, start, end, None)
+                wrapper.flush()
+                wrapper.detach()
+    return 0
 
 
 if __name__ == '__main__':
-    exit(main(sys.argv))
+    from common import run_main
+    run_main(main)
 
 
 # vim:set sw=4 ts=8 sts=4 et sr ft=python fdm=marker tw=0:
@@ -0,0 +1,39 @@
+#!/usr/bin/python
+# File:        js-pack.py
+# Description: convert jstest recordings to the binary event format
+# Created:     2026-10-17
+
+import js
+import argparse
+import sys
+
+
+def main(argv):
+    progname = argv.pop(0).rpartition('/')[2]
+
+    parser = argparse.ArgumentParser(prog=progname, description="""
+    Convert a jstest --event recording to a binary event file, which all
+    tools read without parsing.""")
+    parser.add_argument('input', nargs='?', default='-', help="jstest --event output file (default: stdin)")
+    parser.add_argument('output', nargs='?', default='-', help="Binary output file (default: stdout)")
+    args = parser.parse_args(argv)
+
+    if args.input == '-':
+        source = sys.stdin
+    else:
+        source = open(args.input, 'r')
+    with source:
+        if args.output == '-':
+            js.write_event_file(source, sys.stdout.buffer)
+        else:
+            with open(args.output, 'wb') as out:
+                js.write_event_file(source, out)
+    return 0
+
+
+if __name__ == '__main__':
+    from common import run_main
+    run_main(main)
+
+
+# vim:set sw=4 ts=8 sts=4 et sr ft=python fdm=marker tw=0:
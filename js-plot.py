@@ -5,60 +5,196 @@
 
 import js
 import argparse
-import sys
 from common import ArgvError
 
 
-class PlotHandler(js.Handler):
-
-    lasttime = None
-
-    def __init__(self, evs, allstates, adapters):
-        js.Handler.__init__(self, evs)
-        self.allstates = allstates
-        self.origin_to_adapters = origin_to_adapters = {}
-        self.recorded_events = ev = {}
-        self.directional = set()
-        for adapter in adapters:
-            ev[adapter] = []
-            for o in adapter.origin:
-                try:
-                    olist = origin_to_adapters[o]
-                except KeyError:
-                    origin_to_adapters[o] = olist = []
-                olist.append(adapter)
-
-    def initevents(self, time):
-        for adapter, events in self.recorded_events.items():
-            value = adapter(self.allstates)
-            if isinstance(value, (tuple, list)):
-                self.directional.add(adapter)
-            events.append((time, value))
-
-    def handle_event(self, event):
-        type = event.type & ~js.TY_INIT_BIT
-        num = event.number
-        spec = (type, num)
-        time = event.time
-        self.lasttime = time
-        for adapter in self.origin_to_adapters.get(spec, ()):
-            events = self.recorded_events[adapter]
-            prevevent = events[-1]
-            if prevevent[0] < time - 10:
-                events.append((time - 10, *prevevent[1:]))
-            events.append((time, adapter(self.allstates)))
-
-
-def calculate_directions(events):
+# points drawn per pixel of the axes width by decimate()
+POINTS_PER_PIXEL = 4
+
+
+def spec_key(type, number):
+    return type * 65536 + number
+
+
+class EventColumns(object):
+
+    """Events as numpy columns: time, spec_key() of type and number, value.
+
+    Built from the batches of JsEvents.read_batches. lasttime is the time
+    of the last event, or None."""
+
+    def __init__(self, batches):
+        import numpy as np
+        from itertools import chain
+        JsEvent = js.JsEvent
+        self.lasttime = None
+        chunks = [np.empty(0, dtype=np.int64)]
+        for batch in batches:
+            self.lasttime = batch[-1].time
+            # Event lines in an unusual layout are parsed into Event objects.
+            rows = [e if type(e) is JsEvent else (e.type, e.time, e.number, e.value)
+                    for e in batch if e.ty == "Event"]
+            chunks.append(np.fromiter(chain.from_iterable(rows), dtype=np.int64))
+        rows = np.concatenate(chunks).reshape(-1, 4)
+        self.times = rows[:, 1]
+        self.keys = spec_key(rows[:, 0] & ~js.TY_INIT_BIT, rows[:, 2])
+        self.values = rows[:, 3]
+        self._positions = {}
+
+    def positions(self, spec):
+        """Return the indexes of the events of spec."""
+        import numpy as np
+        try:
+            return self._positions[spec]
+        except KeyError:
+            p = self._positions[spec] = np.flatnonzero(self.keys == spec_key(*spec))
+            return p
+
+    def state_after(self, spec, initial, indexes):
+        """Return the values of spec after the events at indexes."""
+        import numpy as np
+        p = self.positions(spec)
+        if not len(p):
+            return np.full(len(indexes), initial, dtype=np.int64)
+        k = np.searchsorted(p, indexes, side='right') - 1
+        return np.where(k >= 0, self.values[p[np.maximum(k, 0)]], initial)
+
+
+def _sample_calls(columns, adapter, states, indexes):
+    # Adapters that cannot be compiled are called with the states after
+    # each of their events.
+    from types import SimpleNamespace
+    proxy = SimpleNamespace(states=states)
+    samples = [adapter(proxy)]
+    keys = columns.keys.tolist()
+    values = columns.values.tolist()
+    pos = 0
+    for i in indexes.tolist():
+        for key, value in zip(keys[pos:i + 1], values[pos:i + 1]):
+            states[(key >> 16, key & 0xffff)] = value
+        pos = i + 1
+        samples.append(adapter(proxy))
+    if isinstance(samples[0], (tuple, list)):
+        return [list(column) for column in zip(*samples)]
+    return samples
+
+
+def sample_adapter(columns, adapter, allstates, starttime):
+    """Return the times and values of adapter at the start and after each
+    event of its origin.
+
+    Values are an array, or a list of arrays for grouped adapters. allstates
+    holds the states at starttime."""
     import numpy as np
-    array = np.empty((len(events), 3), dtype=np.float64)
-    for i, (time, values) in enumerate(events):
-        array[i, 0] = time
-        array[i, 1:] = values[0], values[1]
-    times = array[:, 0]
-    magnitudes = np.hypot(array[:, 1], array[:, 2])
-    directions = np.arctan2(array[:, 2], array[:, 1])
-    return times, magnitudes, directions
+    import overlayapi as api
+    indexes = np.flatnonzero(np.isin(columns.keys,
+                                     [spec_key(*o) for o in adapter.origin]))
+    times = np.concatenate(([starttime], columns.times[indexes]))
+    state = []
+    try:
+        evaluate = api.compile_adapters([adapter], allstates, values=state,
+                                        fallback=False)
+    except TypeError:
+        value = _sample_calls(columns, adapter, dict(allstates.states), indexes)
+    else:
+        initial = allstates.values
+        for spec, slot in sorted(allstates.slots.items(), key=lambda i: i[1]):
+            state.append(np.concatenate(
+                ([initial[slot]], columns.state_after(spec, initial[slot], indexes))))
+        value, = evaluate(None)
+    if isinstance(value, list):
+        return times, [np.asarray(v, dtype=np.float64) for v in value]
+    return times, np.asarray(value, dtype=np.float64)
+
+
+def add_gap_points(times, values):
+    """Hold each value until 10 ms before the next point if there is a gap.
+
+    values is an array or a list of arrays."""
+    import numpy as np
+    gaps = times[:-1] < times[1:] - 10
+    gapped = np.flatnonzero(gaps) + 1
+    dest = np.arange(len(times))
+    dest[1:] += np.cumsum(gaps)
+
+    def spread(column, gap_values):
+        result = np.empty(len(column) + len(gapped), dtype=column.dtype)
+        result[dest] = column
+        result[dest[gapped] - 1] = gap_values
+        return result
+
+    times = spread(times, times[gapped] - 10)
+    if isinstance(values, list):
+        return times, [spread(v, v[gapped - 1]) for v in values]
+    return times, spread(values, values[gapped - 1])
+
+
+def calculate_directions(values):
+    import numpy as np
+    magnitudes = np.hypot(values[0], values[1])
+    directions = np.arctan2(values[1], values[0])
+    return magnitudes, directions
+
+
+def decimate(times, values, start, stop, width):
+    """Return the indexes of the points needed to draw the series between
+    times start and stop at width pixels.
+
+    Keeps the first, last, minimum and maximum point of each pixel, and
+    the points next to the range. times must be sorted."""
+    import numpy as np
+    lo = max(int(np.searchsorted(times, start, side='left')) - 1, 0)
+    hi = min(int(np.searchsorted(times, stop, side='right')) + 1, len(times))
+    if hi - lo <= POINTS_PER_PIXEL * width or stop <= start:
+        return np.arange(lo, hi)
+    buckets = np.floor((times[lo:hi] - start) * (width / (stop - start))).astype(np.int64)
+    np.clip(buckets, -1, width, out=buckets)
+    firsts = np.flatnonzero(np.diff(buckets, prepend=-2))
+    lasts = np.append(firsts[1:], hi - lo) - 1
+    # buckets are contiguous, so sorting by bucket and value keeps them in
+    # place with their minimum first and maximum last
+    order = np.lexsort((values[lo:hi], buckets))
+    keep = np.unique(np.concatenate((firsts, lasts, order[firsts], order[lasts])))
+    return keep + lo
+
+
+class DecimatedFill(object):
+
+    """fill_between of a series with only the points visible at the axes'
+    resolution, decimated again whenever the x range changes."""
+
+    def __init__(self, plot, times, values, **kwargs):
+        import numpy as np
+        self.plot = plot
+        self.times = times
+        self.values = values
+        self.kwargs = kwargs
+        self.sorted = bool(np.all(times[1:] >= times[:-1]))
+        self.artist = None
+        self.shown = None
+        self.draw(times[0], times[-1])
+        plot.callbacks.connect('xlim_changed', self.on_xlim_changed)
+
+    def draw(self, start, stop):
+        width = max(int(self.plot.bbox.width), 1)
+        if (start, stop, width) == self.shown:
+            return
+        self.shown = start, stop, width
+        if self.sorted:
+            keep = decimate(self.times, self.values, start, stop, width)
+            times = self.times[keep]
+            values = self.values[keep]
+        else:
+            times = self.times
+            values = self.values
+        if self.artist is not None:
+            self.artist.remove()
+        self.artist = self.plot.fill_between(times, values, 0,
+                                             where=abs(values) > .01,
+                                             **self.kwargs)
+
+    def on_xlim_changed(self, plot):
+        self.draw(*plot.get_xlim())
 
 
 def calculate_major_directions(times, magnitudes, directions):
@@ -82,7 +218,8 @@ def calculate_major_directions(times, magnitudes, directions):
         dirmin = dir
         dirmax = dir
         maxmag = mag
-    for time, mag, dir in zip(times, magnitudes, directions):
+    for time, mag, dir in zip(times.tolist(), magnitudes.tolist(),
+                              directions.tolist()):
         if mag < .05:
             endit()
             continue
@@ -156,9 +293,12 @@ def convert_timearg(s, default=None):
 def main(argv):
     progname = argv.pop(0).rpartition('/')[2]
     parser = argparse.ArgumentParser(prog=progname)
+    parser.add_argument('-e', '--events', default='-', help="Text or binary events file (default: stdin)")
     parser.add_argument('-d', '--delay', default=None, help="Additional start delay in seconds")
     parser.add_argument('-s', '-ss', '--start', default=None, help="Start time in seconds (opposite of --delay)")
     parser.add_argument('-S', '--absolute-start', default=None, help="Absolute start time (additional to -s)")
+    parser.add_argument('--no-seek-index', action='store_false', dest='seek_index',
+                        help="Do not create or use the seek index next to the events file")
     parser.add_argument('-T', '--type', default='auto', help="Specify the controller type to use")
     parser.add_argument('-i', '--inputs', nargs='*',
                         default=['STL_X', 'STL_Y', 'STR_X', 'STR_Y', 'LT', 'RT', 'LB', 'RB', 'BACK', 'START', 'GUIDE', 'A', 'B', 'X', 'Y'],
@@ -187,17 +327,20 @@ def main(argv):
 
     adapters = [api.to_adapter(getattr(ctype, name)) for name in args.inputs]
 
-    evs = js.HandlerJsEvents(sys.stdin)
+    evs = js.HandlerJsEvents(js.open_events(args.events))
+    evs.seek_index = args.seek_index
 
     ctype.attach_events(evs)
     allstates = js.AllstatesHandler(evs)
     allstates.attach()
 
     evs.work_all(until='initialized')
+    evs.seek(args.absstart)
     evs.work_all(until=args.absstart)
     firsttime = evs.previous_event.time
     # read until we reach our start time
     starttime = firsttime + args.start - args.delay
+    evs.seek(starttime)
     evs.work_all(until=starttime)
 
     endtime = None
@@ -206,10 +349,11 @@ def main(argv):
     elif args.duration is not None:
         endtime = firsttime + args.duration + args.start - args.delay
 
-    plotter = PlotHandler(evs, allstates, adapters)
-    plotter.initevents(starttime)
-    plotter.attach()
-    evs.work_all(until=endtime)
+    columns = EventColumns(evs.read_batches(until=endtime))
+    lasttime = columns.lasttime
+    series = [add_gap_points(*sample_adapter(columns, adapter, allstates, starttime))
+              for adapter in adapters]
+    del columns
 
     import matplotlib.pyplot as plt
     import numpy as np
@@ -228,38 +372,33 @@ def main(argv):
             firstplot = plot
         plots[num] = (plot, [0, 0])
 
-    for name, adapter in zip(args.inputs, adapters):
+    # matplotlib only keeps weak references to the zoom callbacks
+    fills = []
+    for name, (times, values) in zip(args.inputs, series):
         num = PLOT_IDS.get(name, 1)
 
-        events = plotter.recorded_events[adapter]
-        if adapter in plotter.directional:
-            times, values, directions = calculate_directions(events)
-            major_directions = calculate_major_directions(
-                (times - starttime) * .001, values, directions)
-        else:
-            directions = ()
-            events = np.array(events)
-            times = events[:,0]
-            values = events[:,1]
         times = (times - starttime) * .001
+        if isinstance(values, list):
+            values, directions = calculate_directions(values)
+            major_directions = calculate_major_directions(times, values, directions)
+        else:
+            major_directions = ()
         color = COLORS.get(name, '#000000')
         plot, ranges = plots[num]
-        if any(values < 0):
+        if np.any(values < 0):
             ranges[0] = -1
-        if any(values > 0):
+        if np.any(values > 0):
             ranges[1] = 1
-        if len(directions):
-            for time, angle, maxmag in major_directions:
-                plot.text(time, maxmag + .1, "→", ha='center', va='center',
-                          color=color, rotation=(- angle * 180 / np.pi))
-        plot.fill_between(times, values, 0,
-                          where=abs(values)>.01, alpha=0.5,
-                          color=color, label=name)
-
-    if plotter.lasttime is None:
+        for time, angle, maxmag in major_directions:
+            plot.text(time, maxmag + .1, "→", ha='center', va='center',
+                      color=color, rotation=(- angle * 180 / np.pi))
+        fills.append(DecimatedFill(plot, times, values, alpha=0.5,
+                                   color=color, label=name))
+
+    if lasttime is None:
         print("no events")
     else:
-        end = plotter.lasttime - starttime
+        end = lasttime - starttime
         end *= .001
         for plot, ranges in plots.values():
             plot.vlines([end], ranges[0], ranges[1], '#000000',
@@ -4,7 +4,10 @@
 
 import sys
 import re
-import contextlib
+import struct
+from itertools import chain, repeat, islice, takewhile
+from collections import namedtuple
+from array import array
 
 
 TY_BUTTON = 1
@@ -34,6 +37,56 @@ class Event(object):
                 + ">")
 
 
+EVENT_FORMAT = "Event: type %d, time %d, number %d, value %d"
+
+
+class JsEvent(namedtuple('JsEvent', 'type time number value')):
+
+    """A jstest "Event:" line with its integer fields."""
+
+    __slots__ = ()
+
+    ty = "Event"
+
+    @property
+    def text(self):
+        return EVENT_FORMAT % (self.type, self.time, self.number, self.value)
+
+    def is_type(self, ty):
+        return (self.type & ~TY_INIT_BIT) == ty
+
+    def __repr__(self):
+        return ("<Event: Event: type=%d, time=%d, number=%d, value=%d>"
+                % (self.type, self.time, self.number, self.value))
+
+
+# Only matches numbers as EVENT_FORMAT writes them, so the text of the
+# resulting JsEvent is the line itself.
+_EVENT_PATTERN = (r"Event: type (0|-?[1-9]\d*), time (0|-?[1-9]\d*),"
+                  r" number (0|-?[1-9]\d*), value (0|-?[1-9]\d*)")
+EVENT_LINE = re.compile(_EVENT_PATTERN + r"\n?\Z")
+# all event lines of a chunk of text
+EVENT_LINES = re.compile("^" + _EVENT_PATTERN + "$", re.M)
+WORD_PREFIX = re.compile(r"\w+:")
+
+# size hint for reading regular files in chunks of lines
+READ_HINT = 1 << 16
+
+
+def parse_line(line):
+    """Parse a jstest output line.
+
+    Returns a JsEvent for "Event:" lines in the usual layout, an Event for
+    other lines starting with a word and a colon, or None."""
+    m = EVENT_LINE.match(line)
+    if m is not None:
+        return JsEvent(*map(int, m.groups()))
+    line = line.rstrip('\n')
+    if WORD_PREFIX.match(line) is None:
+        return None
+    return make_event(line)
+
+
 def make_event(line):
     ty, sep, tail = line.partition(":")
     splits = re.split(r", *", tail.strip())
@@ -62,34 +115,231 @@ class LineConvertingReader(object):
         return self.reader.readline().decode('utf-8')
 
 
+BINARY_MAGIC = b"JSEB"
+BINARY_VERSION = 1
+# magic, version, event count, offset of the line table, line count
+BINARY_HEADER = struct.Struct("<4sIQQQ")
+BINARY_LINE = struct.Struct("<QI")
+
+
+class EventFile(object):
+
+    """Binary event recording, read without parsing.
+
+    Events are stored as little-endian columns: time (u32), value (i32),
+    type (u8) and number (u8). Other lines of the recording are kept in a
+    table with the index of the event they preceded. Use write_event_file
+    to create one."""
+
+    def __init__(self, data, file=None):
+        self.file = file
+        self.data = data
+        magic, version, count, lines_offset, nlines = \
+            BINARY_HEADER.unpack_from(data, 0)
+        if magic != BINARY_MAGIC:
+            raise ValueError("not a binary event file")
+        if version != BINARY_VERSION:
+            raise ValueError("unsupported event file version %d" % (version,))
+        self.count = count
+        view = memoryview(data)
+        offset = BINARY_HEADER.size
+        self.times = self._column(view, offset, count, 'I')
+        offset += count * 4
+        self.values = self._column(view, offset, count, 'i')
+        offset += count * 4
+        self.types = view[offset:offset + count]
+        offset += count
+        self.numbers = view[offset:offset + count]
+        lines = []
+        offset = lines_offset
+        for i in range(nlines):
+            index, length = BINARY_LINE.unpack_from(data, offset)
+            offset += BINARY_LINE.size
+            lines.append((index, bytes(view[offset:offset + length]).decode('utf-8')))
+            offset += length
+        # sentinel so next_event never runs out of lines to compare against
+        lines.append((count + 1, None))
+        self.lines = lines
+        self.pos = 0
+        self.linepos = 0
+
+    @staticmethod
+    def _column(view, offset, count, fmt):
+        column = view[offset:offset + count * 4]
+        if sys.byteorder != 'little':
+            column = array(fmt, column)
+            column.byteswap()
+            return column
+        return column.cast(fmt)
+
+    @classmethod
+    def open(cls, file):
+        """Map the given binary file object, or read it if not mappable."""
+        import mmap
+        try:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError, AttributeError):
+            data = file.read()
+        return cls(data, file=file)
+
+    def next_event(self, evs):
+        """Return the next event, passing preceding lines to evs.ignored_line."""
+        i = self.pos
+        lines = self.lines
+        while lines[self.linepos][0] <= i:
+            line = lines[self.linepos][1]
+            self.linepos += 1
+            evs.ignored_line(line)
+        if i >= self.count:
+            return None
+        self.pos = i + 1
+        return tuple.__new__(JsEvent, (self.types[i], self.times[i],
+                                       self.numbers[i], self.values[i]))
+
+    def seek(self, index):
+        """Continue reading with the event at index.
+
+        Lines preceding it are passed on again."""
+        from bisect import bisect_left
+        self.pos = index
+        self.linepos = bisect_left(self.lines, (index,))
+
+    def close(self):
+        for column in (self.times, self.values, self.types, self.numbers):
+            if isinstance(column, memoryview):
+                column.release()
+        if hasattr(self.data, 'close'):
+            self.data.close()
+        if self.file is not None:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_event_file(stream, out):
+    """Convert the jstest output in stream to a binary EventFile in out."""
+    times = array('I')
+    values = array('i')
+    types = array('B')
+    numbers = array('B')
+    lines = []
+
+    def handle_event(event):
+        if event.ty == "Event":
+            times.append(event.time)
+            values.append(event.value)
+            types.append(event.type)
+            numbers.append(event.number)
+        else:
+            lines.append((len(times), event.text))
+
+    evs = JsEvents(stream)
+    evs.handle_event = handle_event
+    evs.ignored_line = lambda line: lines.append((len(times), line))
+    evs.work_all()
+
+    if sys.byteorder != 'little':
+        times.byteswap()
+        values.byteswap()
+    count = len(times)
+    lines_offset = BINARY_HEADER.size + count * 10
+    out.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, count,
+                                 lines_offset, len(lines)))
+    for column in (times, values, types, numbers):
+        out.write(column.tobytes())
+    for index, line in lines:
+        data = line.encode('utf-8')
+        out.write(BINARY_LINE.pack(index, len(data)))
+        out.write(data)
+
+
+def open_events(path):
+    """Open a text or binary recording for use with JsEvents.
+
+    A path of '-' reads from stdin."""
+    import io
+    if path == '-':
+        file = sys.stdin.buffer
+    else:
+        file = open(path, 'rb')
+    try:
+        magic = file.peek(len(BINARY_MAGIC))[:len(BINARY_MAGIC)]
+    except AttributeError:
+        magic = b""
+    if magic == BINARY_MAGIC:
+        return EventFile.open(file)
+    return io.TextIOWrapper(file, encoding='utf-8')
+
+
 class JsEvents(object):
 
+    # whether seek() may use the seek index stored next to the recording
+    seek_index = True
+
     def __init__(self, stream=None):
         self.stream = stream
         self.running = True
         self.exit_status = 0
         self.pending_event = None
         self.previous_event = None
+        # number of events handled by work and work_all
+        self.handled = 0
+        self._events = None
+        self._index = None
 
     def parse_jstest_event(self, line):
-        if not re.match(r"\w+:", line):
-            return None
-        else:
-            return make_event(line)
+        return parse_line(line)
 
     def ignored_line(self, line):
         pass
 
+    def _read_events(self):
+        """Yield the events of the stream, passing other lines to
+        ignored_line as they are reached."""
+        stream = self.stream
+        try:
+            bulk = stream.seekable()
+        except AttributeError:
+            bulk = False
+        if not bulk:
+            # Pipes are read line by line, so live events are not held back.
+            readline = stream.readline
+            chunks = iter(lambda: [readline()], [""])
+        else:
+            chunks = iter(lambda: stream.readlines(READ_HINT), [])
+        findall = EVENT_LINES.findall
+        for lines in chunks:
+            if len(lines) > 1:
+                fields = findall("".join(lines))
+                if len(fields) == len(lines):
+                    # only events, convert all of them at once
+                    ints = list(map(int, chain.from_iterable(fields)))
+                    yield from map(tuple.__new__, repeat(JsEvent),
+                                   zip(ints[0::4], ints[1::4],
+                                       ints[2::4], ints[3::4]))
+                    continue
+            for line in lines:
+                event = self.parse_jstest_event(line)
+                if event is not None:
+                    yield event
+                else:
+                    self.ignored_line(line.rstrip('\n'))
+
     def _next_event(self):
-        while True:
-            line = self.stream.readline()
-            if line == "":
-                return None
-            line = line.rstrip('\n')
-            event = self.parse_jstest_event(line)
-            if event is not None:
-                return event
-            self.ignored_line(line)
+        events = self._events
+        if events is None:
+            stream = self.stream
+            if isinstance(stream, EventFile):
+                from functools import partial
+                events = iter(partial(stream.next_event, self), None)
+            else:
+                events = self._read_events()
+            self._events = events
+        return next(events, None)
 
     def feed(self, line):
         line = line.rstrip('\n')
@@ -105,6 +355,7 @@ class JsEvents(object):
         if event is None:
             self.running = False
             return False
+        self.handled += 1
         self.handle_event(event)
         return self.running
 
@@ -127,11 +378,86 @@ class JsEvents(object):
                     self.pending_event = event
                     return True
             self.previous_event = event
+            self.handled += 1
             self.handle_event(event)
             if not self.running:
                 return False
             event = self._next_event()
 
+    def read_batches(self, until=None, size=1 << 16):
+        """Yield the events up to until in lists of up to size events,
+        without handling them.
+
+        Stops like work_all(until). Other lines are still passed to
+        ignored_line."""
+        event = self.pending_event
+        self.pending_event = None
+        events = iter(self._next_event, None)
+        if event is not None:
+            events = chain((event,), events)
+        if until is not None:
+            def due(event):
+                if event.time > until:
+                    self.pending_event = event
+                    return False
+                return True
+            events = takewhile(due, events)
+        while True:
+            batch = list(islice(events, size))
+            if not batch:
+                break
+            self.previous_event = batch[-1]
+            self.handled += len(batch)
+            yield batch
+        if self.pending_event is None:
+            self.running = False
+
+    def seek(self, until):
+        """Skip to the last checkpoint of the seek index before the first
+        event later than until.
+
+        Has the effect of work_all(until) up to the checkpoint, except that
+        the handlers restore the states stored in the index instead of
+        handling each event. Other lines are still passed to ignored_line.
+        Returns whether events were skipped."""
+        if not self.seek_index or not self.can_skip():
+            return False
+        event = self.pending_event or self.previous_event
+        index = self._index
+        if index is None:
+            import jsindex
+            event_time = getattr(event, 'time', None)
+            if event_time is not None and until - event_time < jsindex.INTERVAL:
+                # too close to be worth building the index
+                return False
+            index = self._index = jsindex.for_stream(self.stream) or False
+        if not index:
+            return False
+        checkpoint = index.find(self.handled, until)
+        if checkpoint is None:
+            return False
+        # the reader already passed on the lines preceding the pending event
+        first = self.handled + (self.pending_event is not None)
+        for line in index.lines_between(first, checkpoint.count):
+            self.ignored_line(line)
+        self.restore(checkpoint.states)
+        self.pending_event = None
+        self.previous_event = parse_line(checkpoint.previous)
+        self.handled = checkpoint.count
+        self._events = None
+        self.stream.seek(checkpoint.offset)
+        return True
+
+    def can_skip(self):
+        """Whether restore() can replace handling events."""
+        return False
+
+    def restore(self, states):
+        """Take the states of the controls after skipped events.
+
+        states maps (type, number) to the value."""
+        pass
+
     def exit(self):
         self.running = False
 
@@ -141,6 +467,9 @@ class JsEvents(object):
 
 class Handler(object):
 
+    # whether restore() can replace handling the events before a seek
+    seekable = False
+
     def __init__(self, events):
         if not isinstance(events, HandlerJsEvents):
             raise TypeError
@@ -158,6 +487,9 @@ class Handler(object):
     def handle_unknown(self, line):
         pass
 
+    def restore(self, states):
+        pass
+
 
 class HandlerJsEvents(JsEvents):
 
@@ -192,35 +524,57 @@ class HandlerJsEvents(JsEvents):
         else:
             self.handlers.remove(handler)
 
-    @contextlib.contextmanager
-    def _handling(self):
-        self.handling = True
-        yield
-        for h in self.removed:
-            self.handlers.remove(h)
-        for h in self.added:
-            self.handlers.append(h)
-        self.added.clear()
-        self.removed.clear()
+    def _done_handling(self):
+        if self.removed or self.added:
+            for h in self.removed:
+                self.handlers.remove(h)
+            for h in self.added:
+                self.handlers.append(h)
+            self.added.clear()
+            self.removed.clear()
         self.handling = False
 
-
     def handle_event(self, event):
-        with self._handling():
-            for h in self.handlers:
-                h.handle_event(event)
+        self.handling = True
+        for h in self.handlers:
+            h.handle_event(event)
+        self._done_handling()
 
     def ignored_line(self, line):
-        with self._handling():
-            for h in self.handlers:
-                h.handle_unknown(line)
+        self.handling = True
+        for h in self.handlers:
+            h.handle_unknown(line)
+        self._done_handling()
+
+    def can_skip(self):
+        return all(h.seekable for h in self.handlers)
+
+    def restore(self, states):
+        for h in self.handlers:
+            h.restore(states)
 
 
 class AllstatesHandler(Handler):
 
+    seekable = True
+
     def __init__(self, events):
         Handler.__init__(self, events)
         self.states = {}
+        # values of the tracked (type, number) pairs, indexed by slot
+        self.slots = {}
+        self.values = []
+
+    def slot(self, spec):
+        """Return the index of spec's value in values.
+
+        From then on values is kept up to date for spec."""
+        try:
+            return self.slots[spec]
+        except KeyError:
+            index = self.slots[spec] = len(self.values)
+            self.values.append(self.states.get(spec, 0))
+            return index
 
     def log(self):
         msg = ""
@@ -228,11 +582,21 @@ class AllstatesHandler(Handler):
             msg += "(%d,%d):%d " % (t, n, v)
         print(msg[:-1] if msg else "")
 
+    def restore(self, states):
+        self.states.clear()
+        self.states.update(states)
+        values = self.values
+        for spec, index in self.slots.items():
+            values[index] = states.get(spec, values[index])
+
     def handle_event(self, event):
         if event.ty == "Event":
             t = event.type & ~TY_INIT_BIT
             n = event.number
             self.states[(t, n)] = event.value
+            index = self.slots.get((t, n))
+            if index is not None:
+                self.values[index] = event.value
 
 
 def start_jstest(device):
@@ -0,0 +1,278 @@
+#!/usr/bin/python
+# File:        jsindex.py
+# Description: seek index for event recordings
+# Created:     2026-10-17
+
+"""Checkpoints into event recordings, to start reading them late without
+handling every earlier event.
+
+A checkpoint is placed every INTERVAL milliseconds of events. It stores the
+position in the recording, the number of events before it, the latest
+event time up to there, the last event and the states of all controls.
+Other lines of the recording are kept with the index of the event they
+precede, so they are still passed on when seeking over them.
+
+The index is stored next to the recording and rebuilt when the recording's
+size or modification time changes."""
+
+import os
+import json
+from bisect import bisect_left, bisect_right
+from itertools import chain, repeat
+import js
+
+
+VERSION = 1
+SUFFIX = ".jsidx"
+# milliseconds of events between checkpoints
+INTERVAL = 10000
+# events per chunk of binary recordings
+BINARY_CHUNK = 4096
+
+
+class Checkpoint(object):
+
+    """State of a recording before the event with index count.
+
+    offset is the stream position: a byte offset into text recordings, the
+    event index in binary ones. latest is the latest time of the events
+    before it, previous the text of the last one, states maps (type,
+    number) to the values after them."""
+
+    __slots__ = ('offset', 'count', 'latest', 'previous', 'states')
+
+    def __init__(self, offset, count, latest, previous, states):
+        self.offset = offset
+        self.count = count
+        self.latest = latest
+        self.previous = previous
+        self.states = states
+
+
+class SeekIndex(object):
+
+    def __init__(self, checkpoints, lines):
+        self.checkpoints = checkpoints
+        # (index of the following event, line) of lines other than events
+        self.lines = lines
+        self._latest = [c.latest for c in checkpoints]
+        self._line_indexes = [i for i, _ in lines]
+
+    def find(self, handled, until):
+        """Return the last checkpoint after the first handled events
+        whose events all have times up to until, or None."""
+        k = bisect_right(self._latest, until) - 1
+        if k < 0:
+            return None
+        checkpoint = self.checkpoints[k]
+        if checkpoint.count <= handled:
+            return None
+        return checkpoint
+
+    def lines_between(self, first, stop):
+        """Return the lines preceding the events first until stop."""
+        indexes = self._line_indexes
+        lo = bisect_left(indexes, first)
+        hi = bisect_left(indexes, stop)
+        return [line for _, line in self.lines[lo:hi]]
+
+    def to_json(self):
+        return {
+            'checkpoints': [[c.offset, c.count, c.latest, c.previous,
+                             [[t, n, v] for (t, n), v in c.states.items()]]
+                            for c in self.checkpoints],
+            'lines': self.lines,
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        checkpoints = [Checkpoint(offset, count, latest, previous,
+                                  {(t, n): v for t, n, v in states})
+                       for offset, count, latest, previous, states
+                       in data['checkpoints']]
+        return cls(checkpoints, [tuple(l) for l in data['lines']])
+
+
+def _text_chunks(file):
+    """Yield (offset, events, lines) for chunks of a text recording.
+
+    lines are the other lines with their index into events. Lines are split
+    as by io.TextIOWrapper, so the events are those JsEvents reads."""
+    findall = js.EVENT_LINES.findall
+    offset = 0
+    for raw in iter(lambda: file.readlines(js.READ_HINT), []):
+        start = offset
+        offset += sum(map(len, raw))
+        text = b"".join(raw).decode('utf-8')
+        if "\r" in text:
+            # universal newlines
+            text = text.replace("\r\n", "\n").replace("\r", "\n")
+        lines = text.split("\n")
+        if lines[-1] == "":
+            lines.pop()
+        fields = findall(text)
+        if len(fields) == len(lines):
+            ints = list(map(int, chain.from_iterable(fields)))
+            yield start, list(map(tuple.__new__, repeat(js.JsEvent),
+                                  zip(ints[0::4], ints[1::4],
+                                      ints[2::4], ints[3::4]))), ()
+            continue
+        events = []
+        others = []
+        for line in lines:
+            event = js.parse_line(line)
+            if event is None:
+                others.append((len(events), line))
+            else:
+                events.append(event)
+        yield start, events, others
+
+
+def _binary_chunks(events):
+    """Yield (offset, events, lines) for chunks of an EventFile."""
+    lines = events.lines
+    linepos = 0
+    for start in range(0, events.count, BINARY_CHUNK):
+        stop = min(start + BINARY_CHUNK, events.count)
+        others = []
+        while lines[linepos][0] < stop:
+            index, line = lines[linepos]
+            others.append((index - start, line))
+            linepos += 1
+        yield start, list(map(tuple.__new__, repeat(js.JsEvent),
+                              zip(events.types[start:stop],
+                                  events.times[start:stop],
+                                  events.numbers[start:stop],
+                                  events.values[start:stop]))), others
+
+
+def build(chunks, interval=INTERVAL):
+    """Return the SeekIndex of a recording read in chunks."""
+    checkpoints = []
+    lines = []
+    states = {}
+    count = 0
+    latest = None
+    checked = None
+    previous = None
+    for offset, events, others in chunks:
+        if latest is not None and latest - checked >= interval:
+            checkpoints.append(Checkpoint(offset, count, latest, previous.text,
+                                          dict(states)))
+            checked = latest
+        lines.extend((count + i, line) for i, line in others)
+        for event in events:
+            if event.ty == "Event":
+                states[(event.type & ~js.TY_INIT_BIT, event.number)] = event.value
+            try:
+                time = event.time
+            except AttributeError:
+                continue
+            if latest is None:
+                latest = checked = time
+            elif time > latest:
+                latest = time
+        if events:
+            count += len(events)
+            previous = events[-1]
+    return SeekIndex(checkpoints, lines)
+
+
+def build_file(path, interval=INTERVAL):
+    with open(path, 'rb') as file:
+        if file.peek(len(js.BINARY_MAGIC))[:len(js.BINARY_MAGIC)] == js.BINARY_MAGIC:
+            with js.EventFile.open(file) as events:
+                return build(_binary_chunks(events), interval)
+        return build(_text_chunks(file), interval)
+
+
+def index_path(path):
+    return path + SUFFIX
+
+
+def _identity(path, interval):
+    st = os.stat(path)
+    return {'version': VERSION, 'size': st.st_size,
+            'mtime_ns': st.st_mtime_ns, 'interval': interval}
+
+
+def load(path, interval=INTERVAL):
+    """Return the stored index of the recording at path, or None if there
+    is none or the recording changed since."""
+    try:
+        with open(index_path(path)) as f:
+            data = json.load(f)
+        if data.get('identity') != _identity(path, interval):
+            return None
+        return SeekIndex.from_json(data)
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def save(index, path, identity):
+    """Store index next to the recording, if its directory is writable."""
+    target = index_path(path)
+    tmppath = "%s.%d.tmp" % (target, os.getpid())
+    data = index.to_json()
+    data['identity'] = identity
+    try:
+        with open(tmppath, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(tmppath, target)
+    except OSError:
+        try:
+            os.unlink(tmppath)
+        except OSError:
+            pass
+
+
+def stream_path(stream):
+    """Return the path of the file stream reads, or None."""
+    if isinstance(stream, js.EventFile):
+        stream = stream.file
+    try:
+        if not stream.seekable():
+            return None
+    except AttributeError:
+        return None
+    name = getattr(stream, 'name', None)
+    if not isinstance(name, str):
+        return None
+    # sys.stdin is named '<stdin>' even if redirected from a file
+    try:
+        if not os.path.samestat(os.fstat(stream.fileno()), os.stat(name)):
+            return None
+    except (OSError, AttributeError, ValueError):
+        return None
+    return name
+
+
+# path -> (identity, SeekIndex) of the indexes used by this process
+_loaded = {}
+
+
+def get(path, interval=INTERVAL):
+    """Return the index of the recording at path, building and storing it
+    if needed."""
+    identity = _identity(path, interval)
+    loaded = _loaded.get(path)
+    if loaded is not None and loaded[0] == identity:
+        return loaded[1]
+    index = load(path, interval)
+    if index is None:
+        index = build_file(path, interval)
+        save(index, path, identity)
+    _loaded[path] = identity, index
+    return index
+
+
+def for_stream(stream, interval=INTERVAL):
+    """Return the index of the recording stream reads, or None if stream
+    is not a file."""
+    path = stream_path(stream)
+    if path is None:
+        return None
+    return get(path, interval)
+
+
+# vim:set sw=4 ts=8 sts=4 et sr ft=python fdm=marker tw=0:
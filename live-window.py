@@ -4,6 +4,7 @@
 # Created:     2017-07-16
 
 
+import sys
 import argparse
 import asyncio
 from contextlib import suppress
@@ -22,8 +23,20 @@ def main(argv):
                         help="Name of the layout to use")
     parser.add_argument('-T', '--theme', default='default',
                         help="Specify the theme to use")
+    parser.add_argument('-r', '--max-fps', type=float, default=None,
+                        help="Redraw at most this many times per second "
+                             "(default: once per display frame)")
+    parser.add_argument('--stats', type=float, default=None, metavar="SECONDS",
+                        help="Print latency statistics to stderr at the given interval")
+    parser.add_argument('--show-stats', action='store_true',
+                        help="Show latency statistics in the window")
     args = parser.parse_args(argv)
 
+    if args.max_fps is not None and args.max_fps <= 0:
+        raise ArgvError("invalid --max-fps: %s" % (args.max_fps,), parser)
+    if args.stats is not None and args.stats <= 0:
+        raise ArgvError("invalid --stats interval: %s" % (args.stats,), parser)
+
     import overlayapi as api
     api.import_all_config()
 
@@ -44,8 +57,8 @@ def main(argv):
     gi.require_version('Gtk', '3.0')
     import gbulb
     import gbulb.gtk
-    from gi.repository import Gtk
-    from live import JsWidget, LiveWorker
+    from gi.repository import Gtk, GLib
+    from live import JsWidget, LiveWorker, LatencyStats
 
     asyncio.set_event_loop_policy(gbulb.gtk.GtkEventLoopPolicy())
     gbulb.install(gtk=True)
@@ -57,7 +70,12 @@ def main(argv):
 
     anim = api.LiveControlsAnimation(context, layout.controls)
     anim.init()
-    jswidget = JsWidget(layout, anim)
+    if args.stats is not None or args.show_stats:
+        stats = LatencyStats()
+    else:
+        stats = None
+    jswidget = JsWidget(layout, anim, max_fps=args.max_fps, stats=stats)
+    jswidget.show_stats = args.show_stats
 
     win = Gtk.Window()
     win.connect("delete-event", lambda *args: task.cancel())
@@ -69,11 +87,17 @@ def main(argv):
     win.add(jswidget)
     win.show_all()
 
-    worker = LiveWorker(args.DEVICE, evs)
+    worker = LiveWorker(args.DEVICE, evs, stats=stats)
     worker.on_init = lambda: jswidget.enable()
-    worker.on_event = lambda: jswidget.queue_draw()
+    worker.on_event = lambda: jswidget.request_draw()
     task = asyncio.ensure_future(worker.do_work())
 
+    if args.stats is not None:
+        def print_stats():
+            print(stats.summary(), file=sys.stderr)
+            return True
+        GLib.timeout_add(int(args.stats * 1000), print_stats)
+
     with suppress(asyncio.CancelledError):
         loop.run_until_complete(task)
 
@@ -5,23 +5,101 @@
 
 
 import re
+import time
+from collections import deque
 from contextlib import suppress
 import asyncio
-from gi.repository import Gtk
+from gi.repository import Gtk, GLib
 import cairo
 
 import js
 
 
+class LatencyStats(object):
+
+    """Rolling latency statistics of the live window.
+
+    latency is the time from receiving the oldest event not yet shown until
+    the widget drew the frame showing it. jstest timestamps come from another
+    clock, so arrival is the delay between an event and its arrival beyond
+    the fastest arrival seen. Events that were drawn in the same frame as an
+    earlier one are counted as coalesced. All times are in seconds."""
+
+    def __init__(self, window=1000):
+        self.latency = deque(maxlen=window)
+        self.arrival = deque(maxlen=window)
+        self.update_times = deque(maxlen=window)
+        self.draw_times = deque(maxlen=window)
+        self.events = 0
+        self.frames = 0
+        self.coalesced = 0
+        self._min_offset = None
+        self._pending = None
+        self._pending_events = 0
+
+    def received(self, event_time, count, now=None):
+        """Record count events received at once, the last one with the
+        jstest timestamp event_time in milliseconds."""
+        if now is None:
+            now = time.monotonic()
+        self.events += count
+        offset = now - event_time / 1000
+        if self._min_offset is None or offset < self._min_offset:
+            self._min_offset = offset
+        self.arrival.append(offset - self._min_offset)
+        if self._pending is None:
+            self._pending = now
+        self._pending_events += count
+
+    def drawn(self, update_time, draw_time, now=None):
+        """Record a frame drawn now, which took the given times to update
+        and draw."""
+        if now is None:
+            now = time.monotonic()
+        self.frames += 1
+        self.update_times.append(update_time)
+        self.draw_times.append(draw_time)
+        if self._pending is not None:
+            self.latency.append(now - self._pending)
+            self.coalesced += self._pending_events - 1
+            self._pending = None
+            self._pending_events = 0
+
+    @staticmethod
+    def percentiles(values, ps=(50, 95, 99)):
+        values = sorted(values)
+        if not values:
+            return (0.0,) * len(ps)
+        last = len(values) - 1
+        return tuple(values[min(last, round(p / 100 * last))] for p in ps)
+
+    def summary(self):
+        return ("latency p50/p95/p99 %.1f/%.1f/%.1f ms,"
+                " arrival %.1f/%.1f/%.1f ms,"
+                " update %.2f ms, draw %.2f ms,"
+                " %d events in %d frames, %d coalesced"
+                % (tuple(v * 1000 for v in self.percentiles(self.latency))
+                   + tuple(v * 1000 for v in self.percentiles(self.arrival))
+                   + (self.percentiles(self.update_times, (50,))[0] * 1000,
+                      self.percentiles(self.draw_times, (50,))[0] * 1000,
+                      self.events, self.frames, self.coalesced)))
+
+
 class JsWidget(Gtk.DrawingArea):
 
     enabled = False
+    show_stats = False
 
-    def __init__(self, layout, anim, scale=15.0):
+    def __init__(self, layout, anim, scale=15.0, max_fps=None, stats=None):
         Gtk.DrawingArea.__init__(self)
 
         self.layout = layout
         self.anim = anim
+        self.stats = stats
+        self.min_interval = 1.0 / max_fps if max_fps else 0.0
+        self._draw_queued = False
+        self._timer = None
+        self._last_draw = 0.0
 
         self.set_size_request(layout.width * scale, layout.height * scale)
         self.connect('draw', self.__on_draw)
@@ -29,7 +107,30 @@ class JsWidget(Gtk.DrawingArea):
     def enable(self):
         self.enabled = True
 
+    def request_draw(self):
+        """Redraw with the current state of the events.
+
+        Requests until the next draw are coalesced. If the last draw is
+        longer ago than the minimum interval, the draw is queued right
+        away, otherwise when the interval is over."""
+        if self._draw_queued or self._timer is not None:
+            return
+        delay = self._last_draw + self.min_interval - time.monotonic()
+        if delay > 0:
+            self._timer = GLib.timeout_add(int(delay * 1000) + 1, self.__on_timer)
+        else:
+            self._draw_queued = True
+            self.queue_draw()
+
+    def __on_timer(self):
+        self._timer = None
+        self._draw_queued = True
+        self.queue_draw()
+        return False
+
     def __on_draw(self, widget, cr):
+        self._draw_queued = False
+        self._last_draw = time.monotonic()
         cr.set_source_rgba(0, 0, 0, 0)
         cr.set_operator(cairo.OPERATOR_SOURCE)
         cr.paint()
@@ -43,23 +144,38 @@ class JsWidget(Gtk.DrawingArea):
             scale_x = width / layout.width
             scale_y = height / layout.height
             scale = min(scale_x, scale_y)
+            start = time.monotonic()
             anim.update()
+            updated = time.monotonic()
             cr.save()
             try:
                 cr.scale(scale, scale)
                 anim.draw(cr)
             finally:
                 cr.restore()
+            stats = self.stats
+            if stats is not None:
+                now = time.monotonic()
+                stats.drawn(updated - start, now - updated, now)
+                if self.show_stats:
+                    cr.set_source_rgba(1, 1, 1, 1)
+                    cr.move_to(4, 12)
+                    cr.show_text(stats.summary())
             if anim.context.needs_update:
                 anim.context.needs_update = False
-                self.queue_draw()
+                self.request_draw()
 
 
 class LiveWorker(object):
 
-    def __init__(self, device_path, evs):
+    # Bytes read at once; all complete lines of a read are fed before
+    # on_event is called.
+    read_size = 65536
+
+    def __init__(self, device_path, evs, stats=None):
         self.device_path = device_path
         self.evs = evs
+        self.stats = stats
 
     async def do_work(self):
         evs = self.evs
@@ -85,10 +201,27 @@ class LiveWorker(object):
                 if event is not None and (event.type & js.TY_INIT_BIT) == 0:
                     break
             self.on_init()
-            async for line in lines:
-                evs.feed(line.decode('utf-8'))
+            stdout = process.stdout
+            stats = self.stats
+            partial = b""
+            while True:
+                data = await stdout.read(self.read_size)
+                if not data:
+                    break
+                lines = (partial + data).split(b"\n")
+                partial = lines.pop()
+                if not lines:
+                    continue
+                count = 0
+                for line in lines:
+                    event = evs.feed(line.decode('utf-8'))
+                    if event is not None and event.ty == "Event":
+                        last = event
+                        count += 1
+                evnum += len(lines)
+                if stats is not None and count:
+                    stats.received(last.time, count)
                 self.on_event()
-                evnum += 1
         finally:
             with suppress(ProcessLookupError):
                 process.terminate()
@@ -97,6 +230,7 @@ class LiveWorker(object):
         pass
 
     def on_event(self):
+        """Called after each batch of lines read at once."""
         pass
 
 
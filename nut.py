@@ -0,0 +1,148 @@
+#!/usr/bin/python
+# File:        nut.py
+# Description: minimal NUT muxer for timestamped raw video
+# Created:     2026-10-17
+
+"""Write a single raw video stream in the NUT container format.
+
+Only what ffmpeg needs to read variable frame rate rawvideo from a pipe is
+implemented: main and stream headers, and one syncpoint before every frame.
+Every frame is a keyframe with an explicitly coded timestamp."""
+
+import struct
+
+
+MAIN_STARTCODE = 0x4E4D7A561F5F04AD
+STREAM_STARTCODE = 0x4E5311405BF2F9DB
+SYNCPOINT_STARTCODE = 0x4E4BE4ADEECA4569
+
+FILE_ID = b"nut/multimedia container\0"
+
+FLAG_KEY = 1
+FLAG_CODED_PTS = 8
+FLAG_SIZE_MSB = 32
+FLAG_CHECKSUM = 64
+FLAG_INVALID = 8192
+
+
+def _make_crc_table():
+    table = []
+    for i in range(256):
+        c = i << 24
+        for _ in range(8):
+            if c & 0x80000000:
+                c = (c << 1) ^ 0x04C11DB7
+            else:
+                c <<= 1
+        table.append(c & 0xFFFFFFFF)
+    return table
+
+_CRC_TABLE = _make_crc_table()
+
+
+def crc(data, value=0):
+    """Checksum used by NUT: polynomial 0x04C11DB7, initial value 0."""
+    table = _CRC_TABLE
+    for b in data:
+        value = ((value << 8) & 0xFFFFFFFF) ^ table[(value >> 24) ^ b]
+    return value
+
+
+def put_v(value):
+    out = bytearray((value & 0x7F,))
+    value >>= 7
+    while value:
+        out.append(0x80 | (value & 0x7F))
+        value >>= 7
+    out.reverse()
+    return bytes(out)
+
+def put_s(value):
+    if value > 0:
+        return put_v(2 * value - 1)
+    return put_v(-2 * value)
+
+def put_vb(data):
+    return put_v(len(data)) + data
+
+
+def packet(startcode, body):
+    forward_ptr = len(body) + 4
+    header = struct.pack(">Q", startcode) + put_v(forward_ptr)
+    if forward_ptr > 4096:
+        header += struct.pack(">I", crc(header))
+    return header + body + struct.pack(">I", crc(body))
+
+
+class NutMuxer(object):
+
+    """Write raw video frames with presentation timestamps.
+
+    Timestamps are in units of 1/fps seconds, so they are frame numbers."""
+
+    version = 3
+    max_distance = 65536
+    msb_pts_shift = 7
+
+    def __init__(self, stream, width, height, fps, fourcc=b"BGRA"):
+        self.stream = stream
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.fourcc = fourcc
+        self.frame_flags = FLAG_KEY | FLAG_CODED_PTS | FLAG_SIZE_MSB | FLAG_CHECKSUM
+
+    def _main_header(self):
+        body = (put_v(self.version)
+                + put_v(1)                  # stream_count
+                + put_v(self.max_distance)
+                + put_v(1)                  # time_base_count
+                + put_v(1) + put_v(self.fps))
+        # frame code 0 codes everything explicitly, all others are invalid
+        for flags, count in ((self.frame_flags, 1), (FLAG_INVALID, 254)):
+            body += (put_v(flags) + put_v(6)
+                     + put_s(0)             # pts delta
+                     + put_v(1)             # size mul
+                     + put_v(0)             # stream id
+                     + put_v(0)             # size lsb
+                     + put_v(0)             # reserved count
+                     + put_v(count))
+        body += put_v(0)                    # header_count_minus1
+        return packet(MAIN_STARTCODE, body)
+
+    def _stream_header(self):
+        body = (put_v(0)                    # stream id
+                + put_v(0)                  # class: video
+                + put_vb(self.fourcc)
+                + put_v(0)                  # time base id
+                + put_v(self.msb_pts_shift)
+                + put_v(self.fps)           # max_pts_distance
+                + put_v(0)                  # decode delay
+                + put_v(0)                  # stream flags
+                + put_vb(b"")               # codec specific data
+                + put_v(self.width) + put_v(self.height)
+                + put_v(0) + put_v(0)       # sample aspect ratio
+                + put_v(0))                 # colorspace type
+        return packet(STREAM_STARTCODE, body)
+
+    def write_header(self):
+        self.stream.write(FILE_ID + self._main_header() + self._stream_header())
+
+    def write_frame(self, pts, data):
+        # Frames are larger than max_distance, so every one needs its own
+        # syncpoint. back_ptr 0 is valid and we never seek in a pipe.
+        syncpoint = packet(SYNCPOINT_STARTCODE, put_v(pts) + put_v(0))
+        header = (b"\0" + put_v(pts + (1 << self.msb_pts_shift))
+                  + put_v(len(data)))
+        header += struct.pack(">I", crc(header))
+        stream = self.stream
+        try:
+            writev = stream.writev
+        except AttributeError:
+            stream.write(syncpoint + header)
+            stream.write(data)
+        else:
+            writev((syncpoint + header, data))
+
+
+# vim:set sw=4 ts=8 sts=4 et sr ft=python fdm=marker tw=0:
@@ -3,6 +3,7 @@
 import sys
 import math
 import js
+from collections import OrderedDict
 
 
 def snap_rect(cctx, x, y, w, h):
@@ -25,9 +26,202 @@ def snap_dist(cctx, d, add=0):
     x, y = cctx.user_to_device_distance(d, 0)
     return cctx.device_to_user_distance(round(x) + add, round(y))[0]
 
+# (label, size, font, linear part of the matrix) -> extents, see label_extents
+_label_extents = {}
+
+def label_extents(cctx, label, size, font="bold"):
+    """Return x bearing and width of label, and the y bearing of "J".
+
+    The font face and size must be selected in cctx. Results are cached
+    for the same label, font size, face and scale."""
+    m = cctx.get_matrix()
+    key = (label, size, font, m.xx, m.yx, m.xy, m.yy)
+    try:
+        return _label_extents[key]
+    except KeyError:
+        pass
+    tx, _, tw, _, _, _ = cctx.text_extents(label)
+    # use fixed text for height calculation to align all texts
+    # regardless of glyph height
+    _, ty, _, _, _, _ = cctx.text_extents("J")
+    extents = _label_extents[key] = (tx, tw, ty)
+    return extents
+
+def label_origin(look, extents):
+    tx, tw, ty = extents
+    cx, cy = look.center
+    return cx - tw / 2 - tx, cy + ty / 2 - ty
+
+def union_bounds(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    x = min(a[0], b[0])
+    y = min(a[1], b[1])
+    return (x, y,
+            max(a[0] + a[2], b[0] + b[2]) - x,
+            max(a[1] + a[3], b[1] + b[3]) - y)
+
+def center_bounds(center, rx, ry):
+    cx, cy = center
+    return (cx - rx, cy - ry, rx * 2, ry * 2)
+
+def device_bounds(cctx, bounds, margin=0):
+    """Return the pixels (x0, y0, x1, y1) touched by bounds in user space,
+    with margin pixels added around them."""
+    bx, by, bw, bh = bounds
+    points = [cctx.user_to_device(x, y)
+              for x in (bx, bx + bw) for y in (by, by + bh)]
+    return (math.floor(min(p[0] for p in points)) - margin,
+            math.floor(min(p[1] for p in points)) - margin,
+            math.ceil(max(p[0] for p in points)) + margin,
+            math.ceil(max(p[1] for p in points)) + margin)
+
+def bounds_overlap(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+class SpriteCache(object):
+
+    """Cache of looks pre-rendered to small surfaces.
+
+    Sprites are keyed by the look, its quantized state (see
+    Look.sprite_key) and the transformation. The least recently used
+    sprites are dropped when their size exceeds budget bytes. cairo is the
+    cairo module the drawing context belongs to."""
+
+    def __init__(self, cairo, budget=32 << 20):
+        self.cairo = cairo
+        self.budget = budget
+        self.size = 0
+        self.sprites = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def counters(self):
+        return (self.hits, self.misses, self.evictions)
+
+    def add_counters(self, counters):
+        hits, misses, evictions = counters
+        self.hits += hits
+        self.misses += misses
+        self.evictions += evictions
+
+    def draw(self, look, cctx):
+        m = cctx.get_matrix()
+        matrix = (m.xx, m.yx, m.xy, m.yy, m.x0, m.y0)
+        state = look.sprite_key(cctx)
+        if state is None:
+            look.on_draw(cctx)
+            return
+        key = (look, state, matrix)
+        sprites = self.sprites
+        try:
+            sprite = sprites[key]
+        except KeyError:
+            self.misses += 1
+            sprite = self._render(look, cctx, matrix)
+            sprites[key] = sprite
+            self.size += sprite[3]
+            while self.size > self.budget and len(sprites) > 1:
+                _, old = sprites.popitem(last=False)
+                self.size -= old[3]
+                self.evictions += 1
+        else:
+            self.hits += 1
+            sprites.move_to_end(key)
+        surface, x, y, _ = sprite
+        cctx.save()
+        try:
+            cctx.identity_matrix()
+            cctx.set_source_surface(surface, x, y)
+            cctx.paint()
+        finally:
+            cctx.restore()
+
+    def _render(self, look, cctx, matrix):
+        # one pixel margin for antialiasing
+        x0, y0, x1, y1 = device_bounds(cctx, look.sprite_bounds(cctx), margin=1)
+        cairo = self.cairo
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, x1 - x0, y1 - y0)
+        sctx = cairo.Context(surface)
+        xx, yx, xy, yy, mx, my = matrix
+        sctx.set_matrix(cairo.Matrix(xx, yx, xy, yy, mx - x0, my - y0))
+        look.on_draw(sctx)
+        surface.flush()
+        return surface, x0, y0, surface.get_stride() * surface.get_height()
+
+
+class LabelMaskCache(object):
+
+    """Labels rasterized to alpha masks.
+
+    A mask is drawn once for each label, font size and transformation, and
+    composited with the text color and alpha of the look after that,
+    instead of laying out the text for every frame. cairo is the cairo
+    module the drawing context belongs to."""
+
+    def __init__(self, cairo, font="bold"):
+        self.cairo = cairo
+        self.font = font
+        self.masks = {}
+
+    def draw(self, look, cctx):
+        m = cctx.get_matrix()
+        size = look.labelargs['size']
+        key = (look.label, size, look.center,
+               m.xx, m.yx, m.xy, m.yy, m.x0, m.y0)
+        try:
+            mask, x, y = self.masks[key]
+        except KeyError:
+            mask, x, y = self.masks[key] = self._render(look, cctx, m, size)
+        cctx.save()
+        try:
+            cctx.identity_matrix()
+            cctx.set_source_rgba(*look.textcolor, look.alpha)
+            cctx.mask_surface(mask, x, y)
+        finally:
+            cctx.restore()
+
+    def _render(self, look, cctx, m, size):
+        cairo = self.cairo
+        label = look.label
+        cctx.save()
+        try:
+            cctx.select_font_face(self.font)
+            cctx.set_font_size(size)
+            ox, oy = label_origin(look, label_extents(cctx, label, size, self.font))
+            bx, by, bw, bh, _, _ = cctx.text_extents(label)
+            points = [cctx.user_to_device(ox + x, oy + y)
+                      for x in (bx, bx + bw) for y in (by, by + bh)]
+        finally:
+            cctx.restore()
+        # one pixel margin for antialiasing
+        x0 = math.floor(min(p[0] for p in points)) - 1
+        y0 = math.floor(min(p[1] for p in points)) - 1
+        x1 = math.ceil(max(p[0] for p in points)) + 1
+        y1 = math.ceil(max(p[1] for p in points)) + 1
+        mask = cairo.ImageSurface(cairo.FORMAT_A8, x1 - x0, y1 - y0)
+        mctx = cairo.Context(mask)
+        mctx.set_matrix(cairo.Matrix(m.xx, m.yx, m.xy, m.yy, m.x0 - x0, m.y0 - y0))
+        mctx.select_font_face(self.font)
+        mctx.set_font_size(size)
+        mctx.move_to(ox, oy)
+        mctx.show_text(label)
+        mask.flush()
+        return mask, x0, y0
+
 
 class Look(object):
 
+    sprite_cache = None
+    label_masks = None
+    background_cached = False
+    # transformation -> snapped geometry, see snapped()
+    _geometry = None
+
     def __init__(self, center, hidetime=None, maxoutstyle='none', label=None, labelargs=None):
         self.center = center
         self.label = label
@@ -45,12 +239,29 @@ class Look(object):
             self.alpha = 0.0
         self.textcolor = theme.textcolor
 
-    def update(self, context, value):
+    def set_value(self, value):
+        """Set the state for the given control value.
+
+        Returns the value between 0 and 1 that determines visibility.
+        Subclasses that change how it is computed also need to extend
+        sample_activity."""
         if value > 1.0:
             value = 1.0
         elif value < 0:
             value = 0
         self.value = value
+        return value
+
+    def sample_activity(self, value):
+        """Return what set_value returns for an array of values."""
+        import numpy as np
+        return np.clip(value, 0, 1.0)
+
+    def set_alpha(self, alpha):
+        self.alpha = alpha
+
+    def update(self, context, value):
+        value = self.set_value(value)
         hidetime = self.hidetime
         if hidetime is not None:
             if value > 0.2:
@@ -61,26 +272,89 @@ class Look(object):
                 context.post_update()
             else:
                 alpha = 0.0
-            self.alpha = alpha
+            self.set_alpha(alpha)
         return value
 
+    def draw_state(self):
+        """Return a comparable value describing what draw() would render.
+
+        Returns None if the look is invisible. Subclasses that draw
+        additional state must extend this."""
+        if self.alpha <= 0.001:
+            return None
+        return (self.value, self.alpha)
+
+    def snapped(self, cctx, name, snap, *args):
+        """Return snap(cctx, *args), computed once per transformation.
+
+        name identifies the geometry, args must not change for it."""
+        m = cctx.get_matrix()
+        key = (m.xx, m.yx, m.xy, m.yy, m.x0, m.y0)
+        cache = self._geometry
+        if cache is None:
+            cache = self._geometry = {}
+        try:
+            geometry = cache[key]
+        except KeyError:
+            if len(cache) >= 8:
+                cache.clear()
+            geometry = cache[key] = {}
+        try:
+            return geometry[name]
+        except KeyError:
+            value = geometry[name] = snap(cctx, *args)
+            return value
+
+    def sprite_key(self, cctx):
+        """Return the quantized state that determines what is drawn to
+        cctx.
+
+        Geometry is taken as snapped to the pixels of cctx, so equal keys
+        draw identical pixels. Returns None if the look cannot be cached as
+        sprite."""
+        return None
+
+    def sprite_bounds(self, cctx):
+        """Return the (x, y, w, h) area on_draw draws to."""
+        return self.label_bounds(cctx)
+
+    def label_bounds(self, cctx):
+        label = self.label
+        if label is None:
+            return None
+        size = self.labelargs['size']
+        cctx.select_font_face("bold")
+        cctx.set_font_size(size)
+        tx, tw, _ = label_extents(cctx, label, size)
+        return center_bounds(self.center, tw / 2 + abs(tx) + size * .5, size)
+
+    def draw_background(self, cctx):
+        """Draw the parts that only depend on layout and theme.
+
+        These parts are left out of following draw() calls."""
+        self.background_cached = True
+
     def draw(self, cctx):
         if self.alpha > 0.001:
-            self.on_draw(cctx)
+            cache = self.sprite_cache
+            if cache is None:
+                self.on_draw(cctx)
+            else:
+                cache.draw(self, cctx)
 
     def on_draw(self, cctx):
         label = self.label
         if label is not None:
+            masks = self.label_masks
+            if masks is not None:
+                masks.draw(self, cctx)
+                return
+            size = self.labelargs['size']
             cctx.select_font_face("bold")
             cctx.set_source_rgba(*self.textcolor, self.alpha)
-            cctx.set_font_size(self.labelargs['size'])
-            cx, cy = self.center
-            # use fixed text for height calculation to align all texts
-            # regardless of glyph height
-            _, ty, _, th, _, dy = cctx.text_extents("J")
-            tx, _, tw, _, dx, _ = cctx.text_extents(self.label)
-            cctx.move_to(cx - tw / 2 - tx, cy + ty / 2 - ty)
-            cctx.show_text(self.label)
+            cctx.set_font_size(size)
+            cctx.move_to(*label_origin(self, label_extents(cctx, label, size)))
+            cctx.show_text(label)
 
 class BgFgLook(Look):
 
@@ -109,11 +383,33 @@ class BgFgLook(Look):
         else:
             self.fgcolor = self.theme.fgcolor
 
-    def update(self, context, value):
-        value = Look.update(self, context, value)
+    def set_value(self, value):
+        value = Look.set_value(self, value)
         self.maxout(value)
         return value
 
+    def draw_state(self):
+        state = Look.draw_state(self)
+        if state is None:
+            return None
+        return (*state, self.fgcolor)
+
+    def draw_background(self, cctx):
+        self.on_draw_background(cctx)
+        self.background_cached = True
+
+    def on_draw(self, cctx):
+        if not self.background_cached:
+            self.on_draw_background(cctx)
+        self.on_draw_foreground(cctx)
+        Look.on_draw(self, cctx)
+
+    def on_draw_background(self, cctx):
+        pass
+
+    def on_draw_foreground(self, cctx):
+        pass
+
 class RectLook(BgFgLook):
 
     def __init__(self, center, size, fancy=True, **kwargs):
@@ -124,25 +420,38 @@ class RectLook(BgFgLook):
         bh = size[1] * self.bgsize
         self.bgbounds = (center[0] - bw * .5, center[1] - bh * .5, bw, bh)
 
-    def on_draw(self, cctx):
+    def sprite_key(self, cctx):
+        return (round(self.alpha * 255), self.fgcolor, self.fg_rect(cctx))
+
+    def sprite_bounds(self, cctx):
+        size = max(self.bgsize, self.fgsize) * .5
+        return union_bounds(center_bounds(self.center, self.size[0] * size,
+                                          self.size[1] * size),
+                            self.label_bounds(cctx))
+
+    def on_draw_background(self, cctx):
         cctx.set_source_rgba(*self.bgcolor, self.bgalpha * self.alpha)
-        bx, by, bw, bh = snap_rect(cctx, *self.bgbounds)
-        cctx.rectangle(bx, by, bw, bh)
+        cctx.rectangle(*self.snapped(cctx, 'bg', snap_rect, *self.bgbounds))
         cctx.fill()
+
+    def fg_rect(self, cctx):
+        """Return the snapped (x, y, w, h) of the foreground."""
+        bx, by, bw, bh = self.snapped(cctx, 'bg', snap_rect, *self.bgbounds)
         sw, sh = self.size
         ev = self.value * self.fgsize
         h = sh * ev
-        cctx.set_source_rgba(*self.fgcolor, self.fgalpha * self.alpha)
         if self.fancy and ev < self.bgsize:
-            cctx.rectangle(*snap_rect(cctx, bx, by + bh - h, bw, h))
-        else:
-            w = sw * ev
-            cx = bx + bw * .5
-            cy = by + bh * .5
-            cx, cy, w, h = snap_rect(cctx, cx, cy, w / 2, h / 2)
-            cctx.rectangle(cx - w, cy - h, w * 2, h * 2)
+            return snap_rect(cctx, bx, by + bh - h, bw, h)
+        w = sw * ev
+        cx = bx + bw * .5
+        cy = by + bh * .5
+        cx, cy, w, h = snap_rect(cctx, cx, cy, w / 2, h / 2)
+        return cx - w, cy - h, w * 2, h * 2
+
+    def on_draw_foreground(self, cctx):
+        cctx.set_source_rgba(*self.fgcolor, self.fgalpha * self.alpha)
+        cctx.rectangle(*self.fg_rect(cctx))
         cctx.fill()
-        BgFgLook.on_draw(self, cctx)
 
 class CircleLook(BgFgLook):
 
@@ -152,39 +461,67 @@ class CircleLook(BgFgLook):
         self.bg = (*center, radius * self.bgsize)
         self.fg = (*center, radius * self.fgsize)
 
-    def update(self, context, value):
-        value = BgFgLook.update(self, context, value)
+    def sprite_key(self, cctx):
+        return (round(self.alpha * 255), self.fgcolor,
+                snap_circle(cctx, *self.fg))
+
+    def sprite_bounds(self, cctx):
+        r = self.radius * max(self.bgsize, self.fgsize)
+        return union_bounds(center_bounds(self.center, r, r),
+                            self.label_bounds(cctx))
+
+    def set_value(self, value):
+        value = BgFgLook.set_value(self, value)
         self.fg = (*self.center, self.radius * self.fgsize * value)
         return value
 
-    def on_draw(self, cctx):
+    def draw_state(self):
+        state = BgFgLook.draw_state(self)
+        if state is None:
+            return None
+        return (*state, self.fg)
+
+    def on_draw_background(self, cctx):
         cctx.set_source_rgba(*self.bgcolor, self.bgalpha * self.alpha)
-        cctx.arc(*snap_circle(cctx, *self.bg), 0, math.pi * 2)
+        cctx.arc(*self.snapped(cctx, 'bg', snap_circle, *self.bg), 0, math.pi * 2)
         cctx.fill()
+
+    def on_draw_foreground(self, cctx):
         cctx.set_source_rgba(*self.fgcolor, self.fgalpha * self.alpha)
         cctx.arc(*snap_circle(cctx, *self.fg), 0, math.pi * 2)
         cctx.fill()
-        BgFgLook.on_draw(self, cctx)
 
 class StickLook(CircleLook):
 
     def __init__(self, center, radius, bgsize=.8, fgsize=.55, **kwargs):
         CircleLook.__init__(self, center, radius, bgsize=bgsize, fgsize=fgsize, **kwargs)
 
-    def update(self, context, value):
+    def set_value(self, value):
         vx, vy, vb = value
         mag = math.hypot(vx, vy)
         if mag > 1.0:
             vx /= mag
             vy /= mag
             mag = 1.0
-        CircleLook.update(self, context, mag)
+        mag = CircleLook.set_value(self, mag)
         space = self.radius * (1.0 - self.fgsize)
         cx, cy = self.center
         cx = cx + space * vx
         cy = cy + space * vy
         self.fg = (cx, cy, self.radius * self.fgsize)
-        return (vx, vy)
+        return mag
+
+    def sample_activity(self, value):
+        import numpy as np
+        vx, vy, vb = value
+        return np.minimum(np.hypot(vx, vy), 1.0)
+
+
+    def sprite_bounds(self, cctx):
+        # the foreground moves within the full radius
+        r = self.radius * max(self.bgsize, 1.0)
+        return union_bounds(center_bounds(self.center, r, r),
+                            self.label_bounds(cctx))
 
 class DpadButtonLook(BgFgLook):
 
@@ -194,37 +531,43 @@ class DpadButtonLook(BgFgLook):
         self.margin = margin
         self.angle = angle
 
-    def on_draw(self, cctx):
+    def shape_bounds(self, cctx, w):
         size = self.size
-        margin = size * self.margin
         cx = size / 2
-
-        def shape_bounds(w):
-            l = snap_dist(cctx, cx - w * .5 + margin, add=-.5)
-            r = snap_dist(cctx, cx + w * .5)
-            h = snap_dist(cctx, w * .25)
-            return l, r, h
-
-        def draw_shape(l, r, h):
-            cctx.move_to(r, h)
-            cctx.line_to(l + h, h)
-            cctx.line_to(l, 0)
-            cctx.line_to(l + h, -h)
-            cctx.line_to(r, -h)
-
-        bg = shape_bounds(size * self.bgsize)
-        fg = shape_bounds(size * self.fgsize)
-        _, ar, ah = shape_bounds(size * self.bgsize * .8)
-
+        l = snap_dist(cctx, cx - w * .5 + size * self.margin, add=-.5)
+        r = snap_dist(cctx, cx + w * .5)
+        h = snap_dist(cctx, w * .25)
+        return l, r, h
+
+    def draw_shape(self, cctx, l, r, h):
+        cctx.move_to(r, h)
+        cctx.line_to(l + h, h)
+        cctx.line_to(l, 0)
+        cctx.line_to(l + h, -h)
+        cctx.line_to(r, -h)
+
+    def on_draw_background(self, cctx):
+        bg = self.snapped(cctx, 'bg', self.shape_bounds, self.size * self.bgsize)
         cctx.save()
         try:
             cctx.rotate(self.angle)
             cctx.set_source_rgba(*self.bgcolor, self.bgalpha * self.alpha)
-            draw_shape(*bg)
+            self.draw_shape(cctx, *bg)
             cctx.fill()
+        finally:
+            cctx.restore()
+
+    def on_draw_foreground(self, cctx):
+        size = self.size
+        fg = self.snapped(cctx, 'fg', self.shape_bounds, size * self.fgsize)
+        _, ar, ah = self.snapped(cctx, 'arrow', self.shape_bounds,
+                                 size * self.bgsize * .8)
+        cctx.save()
+        try:
+            cctx.rotate(self.angle)
             if self.value > .1:
                 cctx.set_source_rgba(*self.fgcolor, self.fgalpha * self.alpha)
-                draw_shape(*fg)
+                self.draw_shape(cctx, *fg)
                 cctx.fill()
             cctx.set_source_rgba(*self.textcolor, self.alpha)
             cctx.move_to(ar, 0)
@@ -233,13 +576,13 @@ class DpadButtonLook(BgFgLook):
             cctx.fill()
         finally:
             cctx.restore()
-        BgFgLook.on_draw(self, cctx)
 
 class DpadGroupLook(Look):
 
     def __init__(self, center, radius, fgsize=1., bgsize=.8,
                  margin=.05, hidetime=None, **kwargs):
         Look.__init__(self, center, hidetime=hidetime, **kwargs)
+        self.radius = radius
         opts = {'fgsize': fgsize, 'bgsize': bgsize, 'margin': margin}
         self.buttons = [
             DpadButtonLook(radius, 0.0, **opts),
@@ -253,7 +596,7 @@ class DpadGroupLook(Look):
         for btn in self.buttons:
             btn.init_theme(theme)
 
-    def update(self, context, value):
+    def set_value(self, value):
         def fix_value(value):
             if value >= .1:
                 return 1.0
@@ -265,18 +608,77 @@ class DpadGroupLook(Look):
         vx = fix_value(vx)
         vy = fix_value(vy)
         buttons = self.buttons
-        buttons[0].update(context, 1.0 if vx > 0.0 else 0.0)
-        buttons[1].update(context, 1.0 if vy > 0.0 else 0.0)
-        buttons[2].update(context, 1.0 if vx < 0.0 else 0.0)
-        buttons[3].update(context, 1.0 if vy < 0.0 else 0.0)
-        Look.update(self, context, 1.0 if vx or vy else 0.0)
-        for b in buttons:
-            b.alpha = self.alpha
+        buttons[0].set_value(1.0 if vx > 0.0 else 0.0)
+        buttons[1].set_value(1.0 if vy > 0.0 else 0.0)
+        buttons[2].set_value(1.0 if vx < 0.0 else 0.0)
+        buttons[3].set_value(1.0 if vy < 0.0 else 0.0)
+        return Look.set_value(self, 1.0 if vx or vy else 0.0)
+
+    def sample_activity(self, value):
+        import numpy as np
+        vx, vy = value
+        active = (np.abs(vx) >= .1) | (np.abs(vy) >= .1)
+        return active.astype(np.float64)
+
+    def set_alpha(self, alpha):
+        self.alpha = alpha
+        for b in self.buttons:
+            b.alpha = alpha
+
+    def draw_state(self):
+        state = Look.draw_state(self)
+        if state is None:
+            return None
+        return (*state, *(b.draw_state() for b in self.buttons))
+
+    def sprite_key(self, cctx):
+        return (round(self.alpha * 255),
+                *((b.value > .1, b.fgcolor) for b in self.buttons))
+
+    def sprite_bounds(self, cctx):
+        r = self.radius
+        return union_bounds(center_bounds(self.center, r, r),
+                            self.label_bounds(cctx))
+
+    def buttons_apart(self, cctx):
+        """Whether no button's foreground comes near another button's
+        background, so drawing all backgrounds first changes nothing.
+
+        cctx is translated to the center. Each shape lies within the
+        90 degree wedge x - |y| >= reach in its button's rotation, see
+        DpadButtonLook.shape_bounds."""
+        def reach(l, r, h):
+            return min(l, r - h)
+        gap = None
+        for btn in self.buttons:
+            size = btn.size
+            bg = btn.snapped(cctx, 'bg', btn.shape_bounds, size * btn.bgsize)
+            fg = btn.snapped(cctx, 'fg', btn.shape_bounds, size * btn.fgsize)
+            _, ar, ah = btn.snapped(cctx, 'arrow', btn.shape_bounds,
+                                    size * btn.bgsize * .8)
+            fgreach = min(reach(*fg), ar - 2 * ah)
+            # wedges of perpendicular buttons are closest
+            g = (fgreach + reach(*bg)) / math.sqrt(2)
+            gap = g if gap is None else min(gap, g)
+        m = cctx.get_matrix()
+        return gap * math.hypot(m.xx, m.yx) >= 2
+
+    def draw_background(self, cctx):
+        cctx.save()
+        try:
+            cctx.translate(*self.snapped(cctx, 'center', snap_point, *self.center))
+            if not self.buttons_apart(cctx):
+                return
+            for btn in self.buttons:
+                btn.draw_background(cctx)
+        finally:
+            cctx.restore()
+        self.background_cached = True
 
     def on_draw(self, cctx):
         cctx.save()
         try:
-            cctx.translate(*snap_point(cctx, *self.center))
+            cctx.translate(*self.snapped(cctx, 'center', snap_point, *self.center))
             for btn in self.buttons:
                 btn.draw(cctx)
         finally:
@@ -301,7 +703,11 @@ class TimeAdapter(object):
         self.duration = int(duration * 1000)
 
     def __call__(self, context):
-        return min(1.0, context.time / self.duration)
+        value = context.time / self.duration
+        if value < 1.0:
+            context.post_update()
+            return value
+        return 1.0
 
 class GroupAdapter(object):
 
@@ -350,6 +756,40 @@ def to_adapter(a, a2=None):
     return SimpleStateAdapter(a)
 
 
+def compile_adapters(adapters, allstates, values=None, fallback=True):
+    """Compile adapters into one function returning all their values.
+
+    State lookups become indexes into allstates.values, or into values if
+    given, and conversions become inline arithmetic. The returned function
+    takes the context. Adapters that cannot be compiled are called as
+    usual, or raise TypeError if fallback is False."""
+    if values is None:
+        values = allstates.values
+    env = {'values': values}
+
+    def expr(a):
+        # resolved AutoDetectControllerType adapter
+        a = getattr(a, 'source', a)
+        if isinstance(a, SimpleStateAdapter):
+            return "v[%d]" % allstates.slot(a.spec)
+        elif isinstance(a, ConvertAdapter):
+            return "(%s * %r + %r)" % (expr(a.adapter), a.factor, a.offset)
+        elif isinstance(a, GroupAdapter):
+            return "[%s]" % ", ".join(expr(x) for x in a.adapters)
+        if not fallback:
+            raise TypeError("cannot compile adapter %r" % (a,))
+        name = "f%d" % len(env)
+        env[name] = a
+        return "%s(context)" % name
+
+    exprs = [expr(a) for a in adapters]
+    code = ("def evaluate(context):\n"
+            "    v = values\n"
+            "    return [%s]\n" % ",\n            ".join(exprs))
+    exec(compile(code, "<compiled adapters>", "exec"), env)
+    return env['evaluate']
+
+
 class Control(object):
 
     def __init__(self, source, look):
@@ -365,6 +805,9 @@ class Control(object):
     def draw(self, cctx):
         return self.look.draw(cctx)
 
+    def draw_state(self):
+        return self.look.draw_state()
+
 
 class Layout(object):
 
@@ -404,6 +847,8 @@ class ControllerType(object):
 class AutoDetectControllerType(ControllerType, js.Handler):
 
     ctype = None
+    # only looks at the header lines
+    seekable = True
 
     def __init__(self):
         self.adapters = []
@@ -438,6 +883,7 @@ class AutoDetectControllerType(ControllerType, js.Handler):
             nonlocal source
             source = to_adapter(getattr(ctype, name))
             adapter.origin = source.origin
+            adapter.source = source
         ctype = self.ctype
         if ctype is None:
             adapter.init = init
@@ -465,48 +911,442 @@ class Context(object):
     def init_time(self, offset, absstart=0):
         evs = self.evs
         evs.work_all(until='initialized')
+        evs.seek(absstart)
         evs.work_all(until=absstart)
         self.offset = evs.previous_event.time + offset
+        self.seek(0)
+
+    def seek(self, time):
+        """Skip events before time using the seek index, if possible.
+
+        The next update processes the remaining ones."""
+        self.evs.seek(self.offset + time)
 
     def update(self, time):
+        self.needs_update = False
         self.evs.work_all(self.offset + time)
         self.time = time
 
+    def next_event_time(self):
+        """Return the time of the next unprocessed event.
+
+        Returns None if there is none (yet)."""
+        event = self.evs.pending_event
+        if event is None:
+            return None
+        return event.time - self.offset
+
+    def is_idle(self):
+        """Whether all events are processed and nothing is animating."""
+        return not self.evs.running and not self.needs_update
+
     def post_update(self):
         self.needs_update = True
 
 
+class NullStats(object):
+
+    """Stand-in for RenderStats that records nothing."""
+
+    def mark(self):
+        pass
+
+    def lap(self, stage):
+        pass
+
+    def frame_done(self, count=1):
+        pass
+
+    def add_bytes(self, count):
+        pass
+
+    def add_copied(self, count):
+        pass
+
+    def queued(self, depth, capacity):
+        pass
+
+NO_STATS = NullStats()
+
+
+class RenderStats(NullStats):
+
+    """Collect where the time of rendering goes.
+
+    Stages are timed as laps: lap(stage) adds the time since the previous
+    lap or mark() to the stage. frame_done() records the time since the
+    frame was started."""
+
+    def __init__(self):
+        import time
+        from array import array
+        self.clock = clock = time.perf_counter
+        self.stages = OrderedDict()
+        self.frame_times = array('d')
+        self.frames = 0
+        self.bytes_written = 0
+        # frame data copied in userspace on the way to the pipe
+        self.bytes_copied = 0
+        # occupancy of the write queue when each frame was queued
+        self.queue_samples = 0
+        self.queue_total = 0
+        self.queue_max = 0
+        self.queue_full = 0
+        self.queue_capacity = 0
+        self.started = clock()
+        self._last = self._frame_start = self.started
+
+    def mark(self):
+        self._last = self._frame_start = self.clock()
+
+    def lap(self, stage):
+        now = self.clock()
+        stages = self.stages
+        stages[stage] = stages.get(stage, 0.0) + now - self._last
+        self._last = now
+
+    def frame_done(self, count=1):
+        now = self.clock()
+        elapsed = (now - self._frame_start) / count
+        self.frame_times.extend([elapsed] * count)
+        self.frames += count
+        self._last = self._frame_start = now
+
+    def add_bytes(self, count):
+        self.bytes_written += count
+
+    def add_copied(self, count):
+        self.bytes_copied += count
+
+    def queued(self, depth, capacity):
+        self.queue_samples += 1
+        self.queue_total += depth
+        self.queue_max = max(self.queue_max, depth)
+        self.queue_capacity = capacity
+        if depth >= capacity:
+            self.queue_full += 1
+
+    def merge(self, other, prefix=""):
+        """Add the stages and frame times recorded by other.
+
+        Stage names of other are prefixed with prefix."""
+        for stage, seconds in other.stages.items():
+            stage = prefix + stage
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+        self.frame_times.extend(other.frame_times)
+        self.frames += other.frames
+        self.bytes_written += other.bytes_written
+        self.bytes_copied += other.bytes_copied
+        self.queue_samples += other.queue_samples
+        self.queue_total += other.queue_total
+        self.queue_max = max(self.queue_max, other.queue_max)
+        self.queue_full += other.queue_full
+        self.queue_capacity = max(self.queue_capacity, other.queue_capacity)
+
+    def percentile(self, p):
+        times = sorted(self.frame_times)
+        if not times:
+            return 0.0
+        return times[min(len(times) - 1, round(p / 100 * (len(times) - 1)))]
+
+    def report(self):
+        """Return the statistics as dict, suitable for JSON."""
+        import resource
+        elapsed = self.clock() - self.started
+        report = {
+            'elapsed': elapsed,
+            'frames': self.frames,
+            'fps': self.frames / elapsed if elapsed > 0 else 0.0,
+            'stages': dict(self.stages),
+            'frame_time': {
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                'max': max(self.frame_times, default=0.0),
+            },
+            'bytes_written': self.bytes_written,
+            'bytes_copied': self.bytes_copied,
+            # kilobytes on Linux
+            'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            'peak_rss_children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+        }
+        samples = self.queue_samples
+        if samples:
+            report['queue'] = {
+                'capacity': self.queue_capacity,
+                'mean': self.queue_total / samples,
+                'max': self.queue_max,
+                # fraction of frames that found the queue full, so the
+                # renderer waited for the writer
+                'full': self.queue_full / samples,
+            }
+        return report
+
+    def print_report(self, file=sys.stderr):
+        report = self.report()
+        elapsed = report['elapsed']
+        print("stats: %d frames in %.2f s, %.1f frames/s"
+              % (report['frames'], elapsed, report['fps']), file=file)
+        for stage, seconds in report['stages'].items():
+            print("  %-14s %9.3f s %5.1f%%" % (stage, seconds,
+                  seconds * 100 / elapsed if elapsed > 0 else 0), file=file)
+        print("  frame time: p50 %.2f ms, p90 %.2f ms, p99 %.2f ms, max %.2f ms"
+              % tuple(report['frame_time'][k] * 1000
+                      for k in ('p50', 'p90', 'p99', 'max')), file=file)
+        queue = report.get('queue')
+        if queue is not None:
+            print("  write queue: mean %.1f, max %d of %d, full %.0f%%"
+                  % (queue['mean'], queue['max'], queue['capacity'],
+                     queue['full'] * 100), file=file)
+        frames = report['frames']
+        print("  written %.1f MiB, copied %.1f MiB (%.0f KiB per frame)"
+              % (report['bytes_written'] / 2**20, report['bytes_copied'] / 2**20,
+                 report['bytes_copied'] / 1024 / frames if frames else 0),
+              file=file)
+        print("  peak RSS %.1f MiB (children %.1f MiB)"
+              % (report['peak_rss'] / 2**20, report['peak_rss_children'] / 2**20),
+              file=file)
+
+    def dump(self, path):
+        import json
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+            f.write("\n")
+
+
 class ControlsAnimation(object):
 
-    def __init__(self, context, controls, fps=60):
+    # seconds of frames sampled at once with timeline
+    timeline_window = 60
+
+    def __init__(self, context, controls, fps=60, dedup=False,
+                 sprite_cache=None, cache_background=False, timeline=False,
+                 label_masks=None, stop=None):
         self.context = context
         self.controls = controls
         self.fps = fps
+        self.dedup = dedup
+        self.sprite_cache = sprite_cache
+        self.label_masks = label_masks
+        self.cache_background = cache_background
+        self.use_timeline = timeline
+        self.timeline = None
+        self.stop = stop
+        self.frames = 0
+        self.reused_frames = 0
+        self.position = 0
+        self.stats = NO_STATS
 
     def init(self, cctx=None):
         for c in self.controls:
             c.init_theme(self.context.theme)
+            c.look.sprite_cache = self.sprite_cache
+            c.look.label_masks = self.label_masks
+        self.evaluate = compile_adapters([c.source for c in self.controls],
+                                         self.context.allstates)
+        self.looks = [c.look for c in self.controls]
+
+    def _new_timeline(self, start, previous=None):
+        from timeline import Timeline
+        nframes = self.timeline_window * self.fps
+        if self.stop is not None:
+            nframes = max(1, min(nframes, self.stop - start))
+        return Timeline(self.context, self.controls, self.fps, nframes,
+                        start=start, previous=previous)
+
+    def _last_timeline(self, timeline):
+        return timeline.final or (self.stop is not None
+                                  and timeline.stop >= self.stop)
+
+    def _timeline_at(self, frame):
+        """Return the timeline of the given frame, sampling the following
+        windows of frames as needed."""
+        timeline = self.timeline
+        if timeline is None:
+            timeline = self.timeline = self._new_timeline(0)
+        while frame >= timeline.stop and not self._last_timeline(timeline):
+            timeline = self.timeline = self._new_timeline(timeline.stop, timeline)
+        return timeline
 
     def update(self, i):
         context = self.context
         time = i * 1000 // self.fps
+        stats = self.stats
+        if self.use_timeline:
+            self._timeline_at(i).apply(self.looks, i)
+            stats.lap('update')
+            return
         context.update(time=time)
-        for c in self.controls:
-            c.update(context)
+        stats.lap('events')
+        for look, value in zip(self.looks, self.evaluate(context)):
+            look.update(context, value)
+        stats.lap('update')
 
     def draw(self, cctx):
         for c in self.controls:
             c.draw(cctx)
 
-    def save(self, writer):
-        with writer.saving():
-            for c in self.controls:
-                c.init_theme(self.context.theme)
-            import itertools
-            for i in itertools.count():
-                self.update(i)
+    def draw_state(self):
+        return tuple(c.draw_state() for c in self.controls)
+
+    def draw_background(self, cctx):
+        """Draw the static background of always visible controls.
+
+        Their looks leave it out afterwards, so every frame has to start
+        from what was drawn here. Controls overlapping controls before
+        them keep drawing their background, so that it still covers
+        those."""
+        drawn = []
+        for c in self.controls:
+            look = c.look
+            bounds = look.sprite_bounds(cctx)
+            if bounds is None:
+                continue
+            bounds = device_bounds(cctx, bounds)
+            if look.hidetime is None and not any(bounds_overlap(bounds, b)
+                                                 for b in drawn):
+                look.draw_background(cctx)
+            drawn.append(bounds)
+
+    def warmup_frames(self):
+        """Return how many frames of history determine the looks' state."""
+        hidetime = max((c.look.hidetime or 0 for c in self.controls), default=0)
+        return hidetime * self.fps // 1000 + 2
+
+    def seek(self, frame):
+        """Restore the state from before the given frame.
+
+        Events are processed up to that frame, but only the frames needed
+        to restore the fade state of the looks are updated. Cannot seek
+        backwards."""
+        if frame < self.position:
+            raise ValueError("cannot seek backwards from frame %d to %d"
+                             % (self.position, frame))
+        first = max(self.position, frame - self.warmup_frames())
+        if self.use_timeline:
+            timeline = self.timeline
+            if timeline is None or (first >= timeline.stop
+                                    and not self._last_timeline(timeline)):
+                # Sample from the first frame of history on.
+                if first > self.position:
+                    self.context.seek(first * 1000 // self.fps)
+                self.timeline = self._new_timeline(first)
+            self.position = frame
+            return
+        if first > self.position:
+            self.context.seek(first * 1000 // self.fps)
+        for i in range(first, frame):
+            self.update(i)
+        self.position = frame
+
+    def static_frames(self, frame, stop=None):
+        """Return how many frames from frame on are identical to the last.
+
+        Nothing changes until the next event is processed, unless a look
+        requested an update."""
+        context = self.context
+        if self.use_timeline:
+            timeline = self._timeline_at(frame)
+            end = timeline.next_change(frame)
+            if end is None and self._last_timeline(timeline):
+                end = frame + self.fps
+            elif end is None:
+                end = timeline.stop
+            if stop is not None:
+                end = min(end, stop)
+            return max(0, end - frame)
+        if context.needs_update:
+            return 0
+        time = context.next_event_time()
+        if time is not None:
+            # first frame whose time reaches the event
+            end = -(-math.ceil(time) * self.fps // 1000)
+        elif not context.evs.running:
+            # No more events, continue in steps to keep checking stop.
+            end = frame + self.fps
+        else:
+            return 0
+        if stop is not None:
+            end = min(end, stop)
+        return max(0, end - frame)
+
+    def render(self, writer, start=0, stop=None):
+        """Render frames from start until stop to writer.
+
+        Renders until the writer fails if stop is None. Returns True if
+        stopped early because all following frames would be identical and
+        the writer holds the last frame.
+
+        With dedup, runs of frames in which no event is processed and
+        nothing animates are handed to the writer as a whole, without
+        updating or comparing the controls for each frame."""
+        dedup = self.dedup
+        stats = self.stats
+        state = None
+        i = start
+        stats.mark()
+        while stop is None or i < stop:
+            self.update(i)
+            i += 1
+            self.position = i
+            if dedup:
+                newstate = self.draw_state()
+                reuse = newstate == state
+                state = newstate
+                stats.lap('compare')
+            else:
+                reuse = False
+            if reuse:
+                # Nothing visible changed, send the previous frame.
+                writer.repeat_frame()
+                self.reused_frames += 1
+            else:
                 self.draw(writer.cctx)
+                stats.lap('draw')
                 writer.save_frame()
+            stats.frame_done()
+            self.frames += 1
+            if writer.holds_last_frame and self.is_idle():
+                # All following frames would be identical.
+                return True
+            if dedup:
+                count = self.static_frames(i, stop)
+                if count > 0:
+                    # Bring the looks to the time of the last frame of the
+                    # run; no events are processed there.
+                    self.update(i + count - 1)
+                    writer.repeat_frame(count)
+                    stats.frame_done(count)
+                    i += count
+                    self.position = i
+                    self.reused_frames += count
+                    self.frames += count
+        return False
+
+    def is_idle(self):
+        """Whether all following frames are identical to the last one."""
+        if self.use_timeline:
+            timeline = self._timeline_at(self.position)
+            return timeline.final and timeline.next_change(self.position) is None
+        return self.context.is_idle()
+
+    def save(self, writer, stop=None, stats=None, start=0):
+        """Render to writer until stop or until the writer fails.
+
+        If stats is given, the time spent in each stage is recorded to it.
+        Rendering begins with frame start, the writer has received the
+        frames before it."""
+        if stats is not None:
+            self.stats = writer.stats = stats
+        if self.dedup:
+            writer.keep_last_frame = True
+        with writer.saving():
+            self.init()
+            if self.cache_background:
+                writer.cache_background(self)
+            if start:
+                self.seek(start)
+            self.render(writer, start=start, stop=stop)
 
 
 class LiveControlsAnimation(ControlsAnimation):
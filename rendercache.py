@@ -0,0 +1,221 @@
+#!/usr/bin/python
+# File:        rendercache.py
+# Description: on-disk cache of rendered overlay streams
+# Created:     2026-10-17
+
+"""Keep rendered overlay streams on disk, to replay them into ffmpeg
+instead of rendering again.
+
+Entries are named by a hash of everything that determines the frames: the
+content of the event file, the rendering options and the source of the
+code drawing them. Each entry stores the frames written to ffmpeg:
+distinct frames compressed with zlib, repetitions of the previous frame as
+counts, and earlier frames seen again as references. The least recently
+used entries are removed when the cache exceeds its size."""
+
+import os
+import json
+import zlib
+import struct
+import hashlib
+
+
+MAGIC = b"JSOC"
+VERSION = 1
+SUFFIX = ".ovl"
+# magic, version, frame size, complete, frame count
+HEADER = struct.Struct("<4sIQIQ")
+# record type, argument: length of compressed frame, index or count
+RECORD = struct.Struct("<cI")
+FRAME = b"F"
+REF = b"D"
+REPEAT = b"R"
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(1 << 20)
+            if not data:
+                return h.hexdigest()
+            h.update(data)
+
+
+class CacheWriter(object):
+
+    """Record the frames of one entry.
+
+    The entry only appears in the cache on close()."""
+
+    def __init__(self, path, tmppath, frame_size, level=1):
+        self.path = path
+        self.tmppath = tmppath
+        self.frame_size = frame_size
+        self.level = level
+        self.frames = 0
+        self._file = open(tmppath, 'wb')
+        self._file.write(HEADER.pack(MAGIC, VERSION, frame_size, 0, 0))
+        self._index = {}
+        self._last = None
+        self._repeats = 0
+
+    def _flush_repeats(self):
+        if self._repeats:
+            self._file.write(RECORD.pack(REPEAT, self._repeats))
+            self._repeats = 0
+
+    def frame(self, data):
+        self.frames += 1
+        last = self._last
+        if last is not None and memoryview(data) == last:
+            self._repeats += 1
+            return
+        self._flush_repeats()
+        data = bytes(data)
+        self._last = data
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        index = self._index.get(digest)
+        if index is not None:
+            self._file.write(RECORD.pack(REF, index))
+            return
+        self._index[digest] = len(self._index)
+        packed = zlib.compress(data, self.level)
+        self._file.write(RECORD.pack(FRAME, len(packed)))
+        self._file.write(packed)
+
+    def repeat(self, count):
+        self.frames += count
+        self._repeats += count
+
+    def close(self, complete):
+        """Add the entry to the cache.
+
+        complete tells whether the stream ended, rather than ffmpeg
+        stopping to read it. Does not replace an existing entry that has
+        more frames."""
+        self._flush_repeats()
+        self._file.seek(0)
+        self._file.write(HEADER.pack(MAGIC, VERSION, self.frame_size,
+                                     int(complete), self.frames))
+        self._file.close()
+        try:
+            existing = read_header(self.path)
+        except (OSError, ValueError):
+            existing = None
+        if existing is not None and not complete and existing[2] >= self.frames:
+            os.unlink(self.tmppath)
+            return
+        os.replace(self.tmppath, self.path)
+
+    def discard(self):
+        self._file.close()
+        os.unlink(self.tmppath)
+
+
+def read_header(path):
+    """Return frame size, completeness and frame count of an entry."""
+    with open(path, 'rb') as f:
+        data = f.read(HEADER.size)
+    if len(data) < HEADER.size:
+        raise ValueError("truncated cache entry")
+    magic, version, frame_size, complete, frames = HEADER.unpack(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("not a cache entry")
+    return frame_size, bool(complete), frames
+
+
+def replay(path, writer):
+    """Write the frames of the entry at path to writer.
+
+    The writer must keep its last frame. Returns the number of frames and
+    whether the entry is complete."""
+    import mmap
+    with open(path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        magic, version, frame_size, complete, frames = HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("not a cache entry")
+        offset = HEADER.size
+        # offsets of the distinct frames, for references
+        stored = []
+        end = len(data)
+        while offset < end:
+            kind, arg = RECORD.unpack_from(data, offset)
+            offset += RECORD.size
+            if kind == FRAME:
+                stored.append((offset, arg))
+                writer.write_frame(zlib.decompress(data[offset:offset + arg]))
+                offset += arg
+            elif kind == REF:
+                start, length = stored[arg]
+                writer.write_frame(zlib.decompress(data[start:start + length]))
+            elif kind == REPEAT:
+                writer.repeat_frame(arg)
+            else:
+                raise ValueError("corrupt cache entry %s" % (path,))
+    return frames, bool(complete)
+
+
+class RenderCache(object):
+
+    """Directory of cached overlay streams, limited to budget bytes."""
+
+    def __init__(self, directory, budget):
+        self.directory = directory
+        self.budget = budget
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(params, sources=()):
+        """Return the key of an entry.
+
+        params is a dict of JSON values that the frames depend on,
+        sources are files whose contents they depend on."""
+        h = hashlib.sha256()
+        h.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+        for path in sorted(set(sources)):
+            h.update(file_digest(path).encode('ascii'))
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + SUFFIX)
+
+    def lookup(self, key):
+        """Return (path, complete, frames) of the entry, or None."""
+        path = self.path(key)
+        try:
+            frame_size, complete, frames = read_header(path)
+            # mark as recently used
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return path, complete, frames
+
+    def recorder(self, key, frame_size):
+        tmppath = os.path.join(self.directory,
+                               ".%s.%d.tmp" % (key, os.getpid()))
+        return CacheWriter(self.path(key), tmppath, frame_size)
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits."""
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(SUFFIX):
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        # keep the newest entry even if it alone exceeds the budget
+        for mtime, size, path in entries[:-1]:
+            if total <= self.budget:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+# vim:set sw=4 ts=8 sts=4 et sr ft=python fdm=marker tw=0:
@@ -0,0 +1,174 @@
+#!/usr/bin/python
+# File:        timeline.py
+# Description: compute the control values of all frames in bulk
+# Created:     2026-10-17
+
+"""Sample the control values of the frames of an offline render at once.
+
+The events of a window of frames are read into arrays. The states are
+forward-filled at the frame times, and the adapters, clamping and hidetime
+fading are applied to whole columns with numpy. Requires numpy."""
+
+import numpy as np
+from overlayapi import Look, compile_adapters
+import js
+
+
+class RecordingHandler(js.Handler):
+
+    def __init__(self, events):
+        js.Handler.__init__(self, events)
+        self.recorded = []
+
+    def handle_event(self, event):
+        if event.ty == "Event":
+            self.recorded.append((event.time, event.type & ~js.TY_INIT_BIT,
+                                event.number, event.value))
+
+
+def _supports_sampling(look):
+    # Looks that override update() may depend on more than the value.
+    for cls in type(look).__mro__:
+        if 'update' in cls.__dict__:
+            return cls is Look
+    return False
+
+
+class Timeline(object):
+
+    """Control values and alphas of the looks of frames start until stop.
+
+    values holds one entry per control: the adapter's values as array, or
+    a list of arrays for grouped adapters. activity and alpha are
+    frames x controls matrices of the clamped value that decides
+    visibility and of the looks' alpha. changed tells for each frame
+    whether any value or alpha differs from the previous frame.
+
+    Reads the events of the context up to the last frame. final tells
+    whether these were all events; the frames then extend until the looks
+    settled, and frames after stop have the state of the last frame.
+    previous is the timeline of the frames just before start, if any, the
+    fade of the looks continues from there."""
+
+    def __init__(self, context, controls, fps, nframes, start=0, previous=None):
+        allstates = context.allstates
+        evs = context.evs
+        looks = [c.look for c in controls]
+        for look in looks:
+            if not _supports_sampling(look):
+                raise TypeError("cannot sample %s" % (type(look).__name__,))
+        columns = []
+        evaluate = compile_adapters([c.source for c in controls], allstates,
+                                    values=columns, fallback=False)
+        initial = list(allstates.values)
+        nframes = max(int(nframes), 1)
+
+        recorder = RecordingHandler(evs)
+        recorder.attach()
+        try:
+            self.final = not evs.work_all(
+                context.offset + (start + nframes - 1) * 1000 // fps)
+        finally:
+            recorder.remove()
+        events = np.array(recorder.recorded, dtype=np.int64).reshape(-1, 4)
+        # Events are processed in order, an event is held back as long as
+        # one before it has a later time.
+        etimes = np.maximum.accumulate(events[:, 0]) if len(events) else events[:, 0]
+
+        if self.final:
+            hidetime = max((look.hidetime or 0 for look in looks), default=0)
+            if len(events):
+                last = etimes[-1] - context.offset
+            elif evs.previous_event is not None:
+                last = evs.previous_event.time - context.offset
+            else:
+                last = 0
+            # frame of the last event, then until fading is done
+            settled = int(-(-last * fps // 1000)) + hidetime * fps // 1000 + 2
+            nframes = max(nframes, settled - start)
+        self.start = start
+        self.stop = start + nframes
+        self.fps = fps
+        times = np.arange(start, start + nframes, dtype=np.int64) * 1000 // fps
+        until = context.offset + times
+
+        # Forward-fill each tracked state at the frame times. An event is
+        # processed in the first frame whose time reaches it.
+        for (type, number), slot in sorted(allstates.slots.items(), key=lambda i: i[1]):
+            mask = (events[:, 1] == type) & (events[:, 2] == number)
+            evalues = events[mask, 3]
+            if not len(evalues):
+                columns.append(np.full(nframes, initial[slot], dtype=np.int64))
+                continue
+            index = np.searchsorted(etimes[mask], until, side='right') - 1
+            column = np.where(index >= 0, evalues[np.maximum(index, 0)],
+                              initial[slot])
+            columns.append(column)
+
+        self.values = values = evaluate(context)
+        activity = np.empty((nframes, len(looks)))
+        alpha = np.empty((nframes, len(looks)))
+        self.last_active = []
+        for k, (look, value) in enumerate(zip(looks, values)):
+            activity[:, k] = look.sample_activity(value)
+            if previous is not None:
+                since = previous.last_active[k]
+            else:
+                since = look.last_active
+            hidetime = look.hidetime
+            if hidetime is None:
+                alpha[:, k] = look.alpha
+                self.last_active.append(since)
+                continue
+            active = activity[:, k] > 0.2
+            last_active = np.maximum.accumulate(np.where(active, times, since))
+            alpha[:, k] = np.where(
+                active, 1.0,
+                np.where(last_active + hidetime > times,
+                         1.0 - (times - last_active) / hidetime, 0.0))
+            self.last_active.append(int(last_active[-1]))
+        self.activity = activity
+        self.alpha = alpha
+
+        changed = np.zeros(nframes, dtype=bool)
+        changed[0] = True
+        changed[1:] |= (alpha[1:] != alpha[:-1]).any(axis=1)
+        for value in values:
+            for column in (value if isinstance(value, list) else (value,)):
+                changed[1:] |= column[1:] != column[:-1]
+        self.changed = changed
+        self._change_frames = np.flatnonzero(changed) + start
+        self._applied = None
+
+    def apply(self, looks, frame):
+        """Put looks into the state of the given frame."""
+        frame = min(frame, self.stop - 1)
+        previous = self._applied
+        self._applied = frame
+        if previous is not None and frame >= previous:
+            # nothing to do if no frame since the previous call changed
+            nxt = self.next_change(previous + 1)
+            if nxt is None or nxt > frame:
+                return
+        row = frame - self.start
+        alpha = self.alpha
+        for k, (look, value) in enumerate(zip(looks, self.values)):
+            # Python values, as the adapters would return them
+            if isinstance(value, list):
+                look.set_value(tuple(c[row].item() for c in value))
+            else:
+                look.set_value(value[row].item())
+            if look.hidetime is not None:
+                look.set_alpha(alpha[row, k].item())
+
+    def next_change(self, frame):
+        """Return the first frame from frame on that differs from its
+        predecessor, or None if there is none."""
+        frames = self._change_frames
+        i = np.searchsorted(frames, frame)
+        if i < len(frames):
+            return int(frames[i])
+        return None
+
+
+# vim:set sw=4 ts=8 sts=4 et sr ft=python fdm=marker tw=0:
@@ -0,0 +1,42 @@
+#!/usr/bin/python
+# File:        unpremultiply.py
+# Description: in-process unpremultiply of bgra frames
+# Created:     2026-10-17
+
+"""Translate frames with premultiplied alpha to non-premultiplied alpha.
+
+Does the same as unpremultiply.c, with identical results, on the frame
+buffer in place. Requires numpy."""
+
+import numpy as np
+
+
+def _make_table():
+    # Same float arithmetic as unpremultiply.c. Rows with alpha 0 and 255
+    # are left unchanged.
+    alpha = np.arange(256, dtype=np.float32)[:, None]
+    color = np.arange(256, dtype=np.float32)[None, :]
+    table = np.empty((256, 256), dtype=np.uint8)
+    table[:] = np.arange(256, dtype=np.uint8)
+    factor = np.float32(255) / alpha[1:255]
+    table[1:255] = np.minimum(np.trunc(color * factor), 255).astype(np.uint8)
+    return table.ravel()
+
+TABLE = _make_table()
+
+
+def unpremultiply(data):
+    """Unpremultiply the writable bgra buffer data in place."""
+    pixels = np.frombuffer(data, dtype=np.uint8).reshape(-1, 4)
+    # Overlay frames are mostly transparent or opaque, only look up the
+    # remaining pixels.
+    partial = np.flatnonzero(pixels[:, 3] - np.uint8(1) < 254)
+    if len(partial):
+        selected = pixels[partial]
+        index = selected[:, 3].astype(np.intp) << 8
+        selected[:, :3] = TABLE[index[:, None] + selected[:, :3]]
+        pixels[partial] = selected
+    return data
+
+
+# vim:set sw=4 ts=8 sts=4 et sr ft=python fdm=marker tw=0: